@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache of arrays parsed from text files
+
+A file's parsed data is kept next to it, in a cache folder, as a .npy
+array (memory-mapped on reading) and a .json header. The header also
+records the size and modification time of the source file, so the cache
+is ignored once the file changes. Both parts are written to a temporary
+file and renamed, the header last, so an interrupted write never leaves a
+cache that looks valid.
+
+Used by ascfile.read_asc (__asccache__).
+"""
+from __future__ import division
+import json
+import os
+
+import numpy as np
+
+
+def _paths(fname, cache_dir):
+    folder, base = os.path.split(os.path.abspath(fname))
+    cache = os.path.join(folder, cache_dir, base)
+    return cache + '.npy', cache + '.json'
+
+
+def _replace(path, write):
+    # write(f) into a temporary file, then rename it over path
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+
+def load(fname, stat, cache_dir):
+    """
+    Cached (header, values) of fname, values memory-mapped read-only, or
+    None when there is no cache or it does not match stat (os.stat of
+    fname).
+    """
+    npy, meta = _paths(fname, cache_dir)
+    try:
+        with open(meta) as f:
+            header = json.load(f)
+        if (header.pop('mtime_ns') != stat.st_mtime_ns
+                or header.pop('size') != stat.st_size):
+            return None
+        return header, np.load(npy, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save(fname, stat, cache_dir, header, values):
+    """
+    Writes the cache of fname: header (JSON-serializable dict) and values
+    array; stat -> os.stat of fname taken before it was parsed.
+    """
+    npy, meta = _paths(fname, cache_dir)
+    info = dict(header, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    try:
+        os.makedirs(os.path.dirname(npy), exist_ok=True)
+        _replace(npy, lambda f: np.save(f, values))
+        _replace(meta, lambda f: f.write(json.dumps(info).encode()))
+    except OSError:
+        # Read-only location, the data is still returned uncached
+        pass
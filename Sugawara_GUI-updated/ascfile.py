@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Reader for HBVX .asc output files
+
+The header metadata (catchment name, start date, number of time points,
+reported error values and PIN parameters) is parsed, and the column block
+is returned as one float64 array. The first read of a file writes a binary
+cache next to it, in __asccache__, keyed by the file size and mtime;
+later reads memory-map that cache instead of parsing the text again.
+"""
+from __future__ import division
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import arraycache
+
+CACHE_DIR = '__asccache__'
+DT_HOURS = 1
+
+_START_RE = re.compile(r'starting date\(YYYYMMDDHH\)\s*(\d{10})')
+_POINTS_RE = re.compile(r'\((\d+) time points\)')
+_ERROR_RE = re.compile(r'^\s*\((\d+)\)\s*(.*?)\s*:\s*(-?[\d.,]+)\s*$')
+
+
+class AscData(object):
+    """
+    Contents of an .asc file.
+
+    catchment -> catchment name
+    start -> numpy datetime64 of time step 1
+    n_points -> number of time points announced in the header
+    errors -> {label: value} error values reported in the header
+    pin -> PIN parameter values listed in the header
+    columns -> column names
+    values -> array(T, n_columns), column-major so every column is a
+              contiguous (and, when cached, memory-mapped) array
+    """
+
+    def __init__(self, fname, header, values):
+        self.fname = fname
+        self.catchment = header['catchment']
+        self.start = np.datetime64(header['start'])
+        self.n_points = header['n_points']
+        self.errors = header['errors']
+        self.pin = header['pin']
+        self.columns = header['columns']
+        self.values = values
+        self._index = dict((c, i) for i, c in enumerate(self.columns))
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __getitem__(self, column):
+        return self.values[:, self._index[column]]
+
+    def time_index(self, dt_hours=DT_HOURS):
+        """datetime64 array with the date of every time step."""
+        return self.start + np.arange(len(self))*np.timedelta64(dt_hours, 'h')
+
+    def to_frame(self):
+        """DataFrame with a leading DateTime column, as samp1 used to build."""
+        data = pd.DataFrame(np.asarray(self.values), columns=self.columns)
+        if 'Time' in self._index:
+            data['Time'] = data['Time'].astype(np.int64)
+        data.insert(loc=0, column='DateTime', value=self.time_index())
+        return data
+
+
+def _parse_header(f):
+    header = {'catchment': None, 'start': None, 'n_points': None,
+              'errors': {}, 'pin': [], 'columns': None}
+    n_lines = 0
+    pin_next = False
+    for line in f:
+        n_lines += 1
+        text = line.strip()
+        if pin_next:
+            header['pin'] = [float(v) for v in text.split(',') if v.strip()]
+            pin_next = False
+        if text.startswith('Name of Catchment:'):
+            header['catchment'] = text.split(':', 1)[1].strip()
+        elif 'parameter(PIN) file' in text:
+            pin_next = True
+        elif text.startswith('Time,'):
+            header['columns'] = [c.strip() for c in text.split(',')]
+            break
+
+        match = _POINTS_RE.search(text)
+        if match:
+            header['n_points'] = int(match.group(1))
+        match = _START_RE.search(text)
+        if match:
+            stamp = match.group(1)
+            header['start'] = '%s-%s-%sT%s:00' % (stamp[:4], stamp[4:6],
+                                                  stamp[6:8], stamp[8:10])
+        match = _ERROR_RE.match(line)
+        if match:
+            # The header uses decimal commas
+            header['errors'][match.group(2)] = float(
+                match.group(3).replace(',', '.'))
+
+    if header['columns'] is None:
+        raise ValueError('no column line found in the .asc header')
+    return header, n_lines
+
+
+def read_asc(fname, cache=True):
+    """
+    Reads an HBVX .asc file into an AscData.
+
+    cache -> use and refresh the binary cache in __asccache__; the cache
+             is rebuilt whenever the file size or modification time changes
+    """
+    stat = os.stat(fname)
+    if cache:
+        cached = arraycache.load(fname, stat, CACHE_DIR)
+        if cached is not None:
+            return AscData(fname, *cached)
+
+    with open(fname) as f:
+        header, n_lines = _parse_header(f)
+    values = pd.read_csv(fname, skiprows=n_lines, header=None,
+                         names=header['columns'], skipinitialspace=True,
+                         dtype=np.float64, engine='c').to_numpy()
+    values = np.asfortranarray(values)
+
+    if cache:
+        arraycache.save(fname, stat, CACHE_DIR, header, values)
+    return AscData(fname, header, values)
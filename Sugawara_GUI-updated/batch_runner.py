@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runner for many catchments
+
+Simulates and/or calibrates every catchment of a manifest CSV on a
+process pool and writes one result file per catchment:
+
+    python batch_runner.py manifest.csv --params para.txt --out results
+    python batch_runner.py manifest.csv --calibrate sce --out results
+
+The manifest has a row per catchment with the columns file (.asc path,
+relative to the manifest), area [km2] and dt [h], plus an optional name
+(the file name by default). Parameters come from a para.txt-style CSV,
+one row for all catchments or one row per name, or from calibration.
+
+Every catchment gets <name>.npz (or <name>.parquet with --format parquet,
+which needs pyarrow) with the simulated flows and states, and <name>.json
+with the parameters, metrics and timings. A catchment whose .json exists
+is skipped, so an interrupted run resumes where it stopped; --force runs
+everything again. summary.csv collects the .json files at the end.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import sugawara
+import metrics
+from ascfile import read_asc
+
+PARAM_NAMES = ('k1', 'k2', 'k3', 'k4', 'd1', 'd2', 'rfcf', 'ecorr')
+FORMATS = ('npz', 'parquet')
+
+
+def read_manifest(fname):
+    """Jobs of the manifest CSV as dicts with name, file, area and dt."""
+    manifest = pd.read_csv(fname, skipinitialspace=True)
+    missing = set(('file', 'area', 'dt')) - set(manifest.columns)
+    if missing:
+        raise ValueError('manifest %s lacks the column(s) %s'
+                         % (fname, ', '.join(sorted(missing))))
+    folder = os.path.dirname(os.path.abspath(fname))
+    jobs = []
+    for row in manifest.to_dict('records'):
+        path = os.path.join(folder, str(row['file']))
+        name = row.get('name')
+        if not isinstance(name, str) or not name:
+            name = os.path.splitext(os.path.basename(path))[0]
+        jobs.append({'name': name, 'file': path, 'area': float(row['area']),
+                     'dt': float(row['dt'])})
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('catchment names in %s are not unique' % fname)
+    return jobs
+
+
+def read_params(fname):
+    """
+    Parameters of a para.txt-style CSV: {name: param} when it has a name
+    column, else {None: param} from the first row.
+    """
+    table = pd.read_csv(fname, skipinitialspace=True, index_col=False)
+    if 'name' in table.columns:
+        return dict((row['name'], [float(row[p]) for p in PARAM_NAMES])
+                    for row in table.to_dict('records'))
+    return {None: [float(table[p][0]) for p in PARAM_NAMES]}
+
+
+def _write(out, name, fmt, q_sim, st_sim, q_rec, param):
+    path = os.path.join(out, '%s.%s' % (name, fmt))
+    tmp = path + '.tmp'
+    if fmt == 'npz':
+        with open(tmp, 'wb') as f:
+            np.savez(f, q_sim=q_sim, states=st_sim, q_rec=q_rec,
+                     param=np.asarray(param, dtype=float))
+    else:
+        pd.DataFrame({'q_sim': q_sim, 'q_rec': q_rec, 's1': st_sim[:, 0],
+                      's2': st_sim[:, 1]}).to_parquet(tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def run_job(job, options):
+    """
+    Runs one catchment and writes its results. Returns the record stored
+    in <name>.json.
+    """
+    sugawara.set_backend(options['backend'])
+    timing = {}
+    start = time.perf_counter()
+    asc = read_asc(job['file'])
+    prec = asc['Rainfall'] + asc['Snowfall']
+    evap = np.asarray(asc['ActualET'])
+    q_rec = np.asarray(asc['Qrec'])
+    extra_param = [job['dt'], job['area']]
+    timing['load'] = time.perf_counter() - start
+
+    record = {'name': job['name'], 'file': job['file']}
+    if options['calibrate']:
+        t0 = time.perf_counter()
+        if options['calibrate'] == 'L-BFGS-B':
+            param = sugawara.calibrate(prec, evap, extra_param, q_rec)[0]
+        else:
+            import calibration
+            param = calibration.calibrate_global(
+                prec, evap, extra_param, q_rec, method=options['calibrate'],
+                seed=options['seed'], workers=1).x
+        timing['calibrate'] = time.perf_counter() - t0
+    else:
+        params = options['params']
+        param = params.get(job['name'], params.get(None))
+        if param is None:
+            raise ValueError('no parameters for catchment %r' % job['name'])
+
+    t0 = time.perf_counter()
+    q_sim, st_sim = sugawara.simulate(prec[:-1], evap[:-1], param,
+                                      extra_param)
+    timing['simulate'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    scores = metrics.evaluate(q_sim, q_rec, warmup=options['warmup'])
+    path = _write(options['out'], job['name'], options['format'], q_sim,
+                  st_sim, q_rec, param)
+    timing['write'] = time.perf_counter() - t0
+    timing['total'] = time.perf_counter() - start
+
+    record.update(output=path, n_steps=len(q_rec),
+                  param=dict(zip(PARAM_NAMES, map(float, param))),
+                  metrics=scores, timing=timing)
+    meta = os.path.join(options['out'], job['name'] + '.json')
+    with open(meta + '.tmp', 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(meta + '.tmp', meta)
+    return record
+
+
+def run(jobs, options, workers=None):
+    """
+    Runs the jobs not completed yet on a process pool.
+    Returns the records of the jobs run and the names of failed jobs.
+    """
+    todo = [job for job in jobs if options['force'] or not os.path.exists(
+        os.path.join(options['out'], job['name'] + '.json'))]
+    print('%d catchments, %d to run' % (len(jobs), len(todo)))
+    records, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(run_job, job, options), job['name'])
+                       for job in todo)
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                record = future.result()
+            except Exception as err:
+                failed.append(name)
+                print('%-24s FAILED %s' % (name, err))
+                continue
+            records.append(record)
+            print('%-24s NSE %7.3f  %8.2f s' % (name, record['metrics']['NSE'],
+                                                record['timing']['total']))
+            sys.stdout.flush()
+    return records, failed
+
+
+def summarize(jobs, out):
+    """Writes summary.csv from the .json records of the jobs done."""
+    rows = []
+    for job in jobs:
+        meta = os.path.join(out, job['name'] + '.json')
+        if not os.path.exists(meta):
+            continue
+        with open(meta) as f:
+            record = json.load(f)
+        row = {'name': record['name'], 'output': record['output'],
+               'n_steps': record['n_steps']}
+        row.update(record['param'])
+        row.update(record['metrics'])
+        row.update(('time_' + k, v) for k, v in record['timing'].items())
+        rows.append(row)
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(out, 'summary.csv'), index=False)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('manifest', help='CSV with file, area and dt columns')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--params', help='para.txt-style parameter CSV')
+    source.add_argument('--calibrate', nargs='?', const='L-BFGS-B',
+                        choices=('L-BFGS-B', 'multistart', 'sce', 'de'),
+                        help='calibrate every catchment (L-BFGS-B default)')
+    parser.add_argument('--out', default='results', help='output folder')
+    parser.add_argument('--format', choices=FORMATS, default='npz')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, one per core by default')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='time steps excluded from the metrics')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='auto',
+                        help='sugawara.simulate backend (auto by default)')
+    parser.add_argument('--force', action='store_true',
+                        help='run again the catchments already done')
+    args = parser.parse_args(argv)
+    if args.format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error('--format parquet needs pyarrow')
+
+    jobs = read_manifest(args.manifest)
+    os.makedirs(args.out, exist_ok=True)
+    options = {'out': args.out, 'format': args.format,
+               'calibrate': args.calibrate, 'seed': args.seed,
+               'warmup': args.warmup, 'force': args.force,
+               'backend': args.backend,
+               'params': read_params(args.params) if args.params else None}
+
+    start = time.perf_counter()
+    records, failed = run(jobs, options, args.workers)
+    wall = time.perf_counter() - start
+    summary = summarize(jobs, args.out)
+
+    if records:
+        timing = pd.DataFrame([r['timing'] for r in records])
+        print('\n%-10s %10s %10s %10s' % ('stage', 'mean', 'max', 'sum'))
+        for stage in timing.columns:
+            print('%-10s %10.3f %10.3f %10.3f' % (
+                stage, timing[stage].mean(), timing[stage].max(),
+                timing[stage].sum()))
+    print('\n%d run, %d failed, %d done in total, %.2f s wall'
+          % (len(records), len(failed), len(summary), wall))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
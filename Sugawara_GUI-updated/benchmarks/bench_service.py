@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the local simulation service
+
+Starts service.SimulationService on output.asc in this process, sends
+--requests score (or simulate) requests from --clients concurrent clients
+over localhost and prints the client-side latency percentiles, the
+throughput and the server statistics:
+
+    python benchmarks/bench_service.py --clients 32 --requests 2000
+    python benchmarks/bench_service.py --window 0     # no batching
+"""
+from __future__ import division, print_function
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import numpy as np
+
+import service
+from calibration import latin_hypercube
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--endpoint', choices=('score', 'simulate'),
+                        default='score')
+    parser.add_argument('--window', type=float, default=service.WINDOW)
+    parser.add_argument('--max-batch', type=int, default=service.MAX_BATCH)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default='auto')
+    args = parser.parse_args(argv)
+
+    data = {'output': service.load_dataset(
+        os.path.join(os.path.dirname(HERE), 'output.asc'), 147.0, 1)}
+    server = service.SimulationService(
+        data, window=args.window,
+        max_batch=args.max_batch if args.window else 1,
+        workers=args.workers, backend=args.backend)
+    port = service.run_in_thread(server)
+    url = 'http://127.0.0.1:%d/%s' % (port, args.endpoint)
+    params = latin_hypercube(args.requests, np.random.default_rng(0))
+    # Warm up the workers (imports, compiled kernels)
+    service.request(url, {'dataset': 'output', 'param': list(params[0])})
+
+    def call(param):
+        start = time.perf_counter()
+        service.request(url, {'dataset': 'output', 'param': list(param)})
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as pool:
+        latencies = np.array(list(pool.map(call, params)))
+    wall = time.perf_counter() - start
+
+    print('%d requests, %d clients, window %.3f s'
+          % (args.requests, args.clients, args.window))
+    print('client p50 %.4f s  p99 %.4f s  throughput %.1f req/s'
+          % (np.percentile(latencies, 50), np.percentile(latencies, 99),
+             args.requests/wall))
+    print('server %s' % service.request(
+        'http://127.0.0.1:%d/stats' % port))
+    server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
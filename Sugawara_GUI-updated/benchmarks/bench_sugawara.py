@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the Sugawara tank model
+
+Times _step, simulate, NSE and calibrate on 10^3, 10^5 and 10^6 time
+steps of forcing built by repeating output.asc. Results can be saved as a
+JSON baseline and later runs compared against it:
+
+    python benchmarks/bench_sugawara.py --save baseline.json
+    python benchmarks/bench_sugawara.py --compare baseline.json
+
+--compare prints the ratio to the baseline for every case and exits with
+status 1 when any case is slower than the baseline by more than
+--tolerance (20% by default). calibrate is timed with maxiter=2 so that
+every size finishes in bounded time.
+
+--backend selects the sugawara.simulate backend being timed (that the
+backends agree with the Python reference is checked by
+tests/test_backends.py):
+
+    python benchmarks/bench_sugawara.py --backend numba --only simulate
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import numpy as np
+
+import sugawara
+from ascfile import read_asc
+from cache import CACHE
+
+SIZES = (10**3, 10**5, 10**6)
+EXTRA_PARAM = [1, 147.0]
+
+
+def forcing(n_steps):
+    """prec, evap and q_rec of n_steps time steps, tiling output.asc."""
+    asc = read_asc(os.path.join(os.path.dirname(HERE), 'output.asc'))
+    reps = -(-n_steps//len(asc))
+    prec = np.tile(asc['Rainfall'] + asc['Snowfall'], reps)[:n_steps]
+    evap = np.tile(asc['ActualET'], reps)[:n_steps]
+    q_rec = np.tile(asc['Qrec'], reps)[:n_steps]
+    return prec, evap, q_rec
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_step(prec, evap, q_rec):
+    param = sugawara.INITIAL_PARAM
+    st = sugawara.INITIAL_STATES
+    step = sugawara._step
+
+    def run():
+        for i in range(len(prec)):
+            step(prec[i], evap[i], st, param, EXTRA_PARAM)
+    return run
+
+
+def bench_simulate(prec, evap, q_rec):
+    return lambda: sugawara.simulate(prec, evap, sugawara.INITIAL_PARAM,
+                                     EXTRA_PARAM)
+
+
+def bench_nse(prec, evap, q_rec):
+    q_sim = sugawara.simulate(prec, evap, sugawara.INITIAL_PARAM,
+                              EXTRA_PARAM, return_states=False)[0][1:]
+    return lambda: sugawara.NSE(q_sim, q_rec)
+
+
+def bench_calibrate(prec, evap, q_rec):
+    def func():
+        # Memoized results would make every repeat after the first free
+        CACHE.clear()
+        return sugawara.calibrate(prec, evap, EXTRA_PARAM, q_rec, maxiter=2)
+    return func
+
+
+BENCHMARKS = (('_step', bench_step), ('simulate', bench_simulate),
+              ('NSE', bench_nse), ('calibrate', bench_calibrate))
+
+
+def run(sizes, names, repeat):
+    results = {}
+    for n_steps in sizes:
+        prec, evap, q_rec = forcing(n_steps)
+        for name, setup in BENCHMARKS:
+            if names and name not in names:
+                continue
+            func = setup(prec, evap, q_rec)
+            # Large cases are timed once, small ones take the best of repeat
+            n_rep = repeat if n_steps <= 10**5 else 1
+            key = '%s[%d]' % (name, n_steps)
+            results[key] = best_of(func, n_rep)
+            print('%-22s %10.4f s' % (key, results[key]))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    slower = []
+    print('\n%-22s %10s %10s %7s' % ('case', 'baseline', 'current', 'ratio'))
+    for key, value in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = value/baseline[key]
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  SLOWER'
+            slower.append(key)
+        print('%-22s %10.4f %10.4f %7.2f%s' % (key, baseline[key], value,
+                                               ratio, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of time steps to benchmark')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='run only these benchmarks (%s)'
+                        % ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--backend', default='python',
+                        help='simulate backend (%s or auto)'
+                        % ', '.join(sorted(sugawara.BACKENDS)))
+    args = parser.parse_args(argv)
+
+    print('backend: %s' % sugawara.set_backend(args.backend))
+    results = run(args.sizes, args.only, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'machine': platform.platform(),
+                       'backend': sugawara.get_backend(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
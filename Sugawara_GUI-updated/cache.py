@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for model evaluations and calibration results
+
+Keys are SHA-1 digests of the values they stand for (forcing arrays,
+extra_param, parameter vectors, settings), so equal inputs give equal keys
+in any process and across runs. Entries live in an in-memory LRU tier and,
+when a directory is configured, in an on-disk tier of pickle files that is
+trimmed, least recently used first, to a maximum total size.
+
+CACHE is the process-wide instance used by sugawara.calibrate and the
+calibration module; configure() adds the disk tier or resizes it.
+"""
+from __future__ import division
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MAX_ITEMS = 4096
+MAX_BYTES = 256*2**20
+
+
+def _update(digest, value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update(('%s%s' % (value.dtype.str, value.shape)).encode())
+        digest.update(value.view(np.uint8).ravel())
+    elif isinstance(value, (list, tuple)):
+        digest.update(('%s%d' % (type(value).__name__, len(value))).encode())
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, dict):
+        _update(digest, sorted(value.items()))
+    else:
+        digest.update(repr(value).encode())
+    digest.update(b';')
+
+
+def key(*values):
+    """
+    Hex digest of values: arrays by dtype, shape and content, lists,
+    tuples and dicts item by item, anything else by repr.
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        _update(digest, value)
+    return digest.hexdigest()
+
+
+class Cache(object):
+    """
+    Two-tier LRU cache.
+
+    max_items -> entries kept in memory
+    directory -> folder of the on-disk tier, None for memory only
+    max_bytes -> total size of the on-disk tier
+
+    hits, disk_hits and misses count the lookups; a disk hit is also
+    counted in hits and promotes the entry to memory.
+    """
+
+    def __init__(self, max_items=MAX_ITEMS, directory=None,
+                 max_bytes=MAX_BYTES):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+
+    def _path(self, k):
+        return os.path.join(self.directory, k + '.pkl')
+
+    def get(self, k, default=None):
+        with self._lock:
+            if k in self._memory:
+                self._memory.move_to_end(k)
+                self.hits += 1
+                return self._memory[k]
+        if self.directory is not None:
+            path = self._path(k)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                os.utime(path)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            else:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self._remember(k, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, k, value, persist=True):
+        """
+        Stores value under key k; persist=False keeps it out of the disk
+        tier (cheap, numerous entries such as objective values).
+        """
+        self._remember(k, value)
+        if self.directory is None or not persist:
+            return
+        path = self._path(k)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            size = os.path.getsize(path)
+        except OSError:
+            # Read-only location, the value stays in memory only
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += size
+        self._trim_disk()
+
+    def _remember(self, k, value):
+        with self._lock:
+            self._memory[k] = value
+            self._memory.move_to_end(k)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def _trim_disk(self):
+        with self._lock:
+            if self._disk_bytes is not None \
+                    and self._disk_bytes <= self.max_bytes:
+                return
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            entries.sort()
+            total = sum(e[1] for e in entries)
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+            self._disk_bytes = total
+
+    def clear(self, disk=False):
+        """Empties the memory tier, and the disk tier if disk is True."""
+        with self._lock:
+            self._memory.clear()
+            if disk and self.directory is not None \
+                    and os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith('.pkl'):
+                        os.remove(os.path.join(self.directory, name))
+                self._disk_bytes = 0
+
+    def stats(self):
+        """Counters and sizes as a dict."""
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'items': len(self._memory),
+                    'disk_bytes': self._disk_bytes}
+
+
+CACHE = Cache()
+
+
+def configure(directory=None, max_items=MAX_ITEMS, max_bytes=MAX_BYTES):
+    """Sets the tiers of the process-wide CACHE."""
+    with CACHE._lock:
+        CACHE.directory = directory
+        CACHE.max_items = max_items
+        CACHE.max_bytes = max_bytes
+        CACHE._disk_bytes = None
+    return CACHE
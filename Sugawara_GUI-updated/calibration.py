@@ -0,0 +1,646 @@
+# -*- coding: utf-8 -*-
+"""
+Global calibration engine for the Sugawara tank model
+
+Strategies
+    multistart  L-BFGS-B started from INITIAL_PARAM and Latin-hypercube
+                points inside PARAM_BND, local searches run in parallel
+    sce         Shuffled Complex Evolution (SCE-UA, Duan et al. 1992)
+    de          Differential evolution (rand/1/bin with dithering)
+
+Objective evaluations run on a process pool sized to the machine. Every
+random draw comes from one seeded generator in the parent process, or for
+the SCE complexes from streams seeded by it, and the default population
+sizes are fixed, so a given seed gives the same result whatever the number
+of workers.
+
+recalibrate refines a previous optimum after new records are appended,
+optionally on a recent window started from checkpointed model states.
+"""
+from __future__ import division
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.optimize as opt
+
+import instrument
+import sugawara
+import worker
+from cache import CACHE, key
+from sugawara import LOWER, UPPER
+from worker import default_workers
+
+PENALTY = 9999.0
+# Below this many parameter sets the scalar simulate loop is faster than
+# the masked NumPy step of simulate_batch
+BATCH_MIN = 8
+METHODS = ('multistart', 'sce', 'de')
+# Default local searches of multistart and complexes of SCE, independent
+# of the number of workers so that results do not depend on it
+N_STARTS = 8
+N_COMPLEXES = 4
+
+
+
+class Objective(object):
+    """
+    Negative NSE of the simulated flow against q_rec.
+
+    Follows sugawara.calibrate: the model is driven by prec[:-1] and
+    evap[:-1] so that the simulated series lines up with q_rec. Failed or
+    non-finite evaluations score PENALTY. Single evaluations are memoized
+    in cache.CACHE under the digest of the data (key) and the parameters.
+
+    weights -> optional weights(T) of the time steps, giving the weighted
+               NSE 1 - sum(w*e**2)/sum(w*(q_rec - weighted mean)**2)
+    initial_states -> [S1, S2] to start from, INITIAL_STATES by default
+    """
+
+    def __init__(self, prec, evap, extra_param, q_rec, weights=None,
+                 initial_states=None):
+        self.prec = np.asarray(prec, dtype=float)[:-1]
+        self.evap = np.asarray(evap, dtype=float)[:-1]
+        self.extra_param = list(extra_param)
+        self.q_rec = np.asarray(q_rec, dtype=float)
+        self.weights = None
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=float)
+        self.initial_states = None
+        if initial_states is not None:
+            self.initial_states = np.asarray(initial_states, dtype=float)
+        if self.weights is None:
+            mean = self.q_rec.mean()
+        else:
+            mean = np.dot(self.weights, self.q_rec)/self.weights.sum()
+        self.denom = self._sse(self.q_rec - mean)
+        self.key = key(self.prec, self.evap, self.extra_param, self.q_rec,
+                       self.weights, self.initial_states)
+
+    def result_key(self, *values):
+        """
+        Cache key of a result on this data, also covering the model
+        version and the simulate backend, so that results of older model
+        code or of another backend are not reused.
+        """
+        return key(self.key, sugawara.MODEL_VERSION, sugawara.get_backend(),
+                   *values)
+
+    def _sse(self, err):
+        # Sums over the last axis row by row, in the same order whatever
+        # the number of rows, so that a batch gives bit for bit the values
+        # of single evaluations and results do not depend on how a
+        # population is split between workers
+        if self.weights is None:
+            return np.einsum('...i,...i->...', err, err)
+        return np.einsum('...i,...i->...', self.weights*err, err)
+
+    @instrument.timed('objective')
+    def __call__(self, param):
+        param = np.asarray(param, dtype=float)
+        k = self.result_key('fun', param)
+        fun = CACHE.get(k)
+        if fun is None:
+            fun = self._fun(param)
+            CACHE.put(k, fun, persist=False)
+        return fun
+
+    @instrument.timed('objective.fun')
+    def _fun(self, param):
+        q_sim = sugawara.simulate(self.prec, self.evap, param,
+                                  self.extra_param, return_states=False,
+                                  initial_states=self.initial_states)[0]
+        fun = self._sse(q_sim - self.q_rec)/self.denom - 1.0
+        return fun if np.isfinite(fun) else PENALTY
+
+    @instrument.timed('objective.value_and_grad')
+    def value_and_grad(self, param):
+        """Objective and its exact gradient from sugawara.simulate_sens."""
+        param = np.asarray(param, dtype=float)
+        k = self.result_key('grad', param)
+        cached = CACHE.get(k)
+        if cached is None:
+            cached = self._fun_and_grad(param)
+            CACHE.put(k, cached, persist=False)
+        return cached[0], cached[1].copy()
+
+    @instrument.timed('objective.grad')
+    def _fun_and_grad(self, param):
+        q_sim, dq_sim = sugawara.simulate_sens(
+            self.prec, self.evap, param, self.extra_param,
+            initial_states=self.initial_states)
+        err = q_sim - self.q_rec
+        fun = self._sse(err)/self.denom - 1.0
+        if not np.isfinite(fun):
+            return PENALTY, np.zeros(len(param))
+        if self.weights is not None:
+            err = self.weights*err
+        return fun, 2.0*np.dot(err, dq_sim)/self.denom
+
+    @instrument.timed('objective.batch',
+                      items=lambda self, params: len(params))
+    def batch(self, params):
+        """Objective for every row of the parameter matrix(N, 8)."""
+        if len(params) < BATCH_MIN:
+            return np.array([self(param) for param in params])
+        q_sim = sugawara.simulate_batch(self.prec, self.evap, params,
+                                        self.extra_param,
+                                        return_states=False,
+                                        initial_states=self.initial_states)[0]
+        # One contiguous row per parameter set
+        err = np.subtract(q_sim.T, self.q_rec, order='C')
+        fun = self._sse(err)/self.denom - 1.0
+        fun[~np.isfinite(fun)] = PENALTY
+        return fun
+
+
+# Pool tasks, on the Objective installed by worker.install
+
+def _evaluate_chunk(params):
+    return worker.STATE['calibration'].batch(params)
+
+
+def _value_and_grad(param):
+    return worker.STATE['calibration'].value_and_grad(param)
+
+
+def _simulate_flow(param):
+    objective = worker.STATE['calibration']
+    return sugawara.simulate(objective.prec, objective.evap, param,
+                             objective.extra_param, return_states=False,
+                             initial_states=objective.initial_states)[0]
+
+
+def _evolve_complexes(cx, cf, seeds, beta, q):
+    # beta competitive complex evolution steps of the complexes cx(p, m, d)
+    # with sorted objective values cf(p, m), complex k drawing its random
+    # numbers from seeds[k] only; the complexes step together so each step
+    # evaluates one batch
+    objective = worker.STATE['calibration']
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    p, m, d = cx.shape
+    rows = np.arange(p)
+    # Trapezoidal selection probabilities for the sub-complex
+    prob = 2.0*(m - np.arange(m))/(m*(m + 1))
+
+    def random_points(which, lo, hi):
+        return np.array([lo[k] + rngs[k].random(d)*(hi[k] - lo[k])
+                         for k in np.flatnonzero(which)]).reshape(-1, d)
+
+    nfev = 0
+    for _ in range(beta):
+        idx = np.array([np.sort(r.choice(m, q, replace=False, p=prob))
+                        for r in rngs])
+        sx = np.take_along_axis(cx, idx[:, :, None], axis=1)
+        worst_i = idx[:, -1]
+        worst = sx[:, -1]
+        worst_f = cf[rows, worst_i]
+        centroid = sx[:, :-1].mean(axis=1)
+        lo = cx.min(axis=1)
+        hi = cx.max(axis=1)
+
+        # Reflection, replaced by a random point if it leaves the box
+        new = 2.0*centroid - worst
+        out = np.any((new < LOWER) | (new > UPPER), axis=1)
+        new[out] = random_points(out, lo, hi)
+        new_f = objective.batch(new)
+        nfev += p
+
+        # Contraction
+        bad = new_f > worst_f
+        if bad.any():
+            new[bad] = 0.5*(centroid[bad] + worst[bad])
+            new_f[bad] = objective.batch(new[bad])
+            nfev += bad.sum()
+        # Random point inside the complex
+        bad = new_f > worst_f
+        if bad.any():
+            new[bad] = random_points(bad, lo, hi)
+            new_f[bad] = objective.batch(new[bad])
+            nfev += bad.sum()
+
+        cx[rows, worst_i] = new
+        cf[rows, worst_i] = new_f
+        order = np.argsort(cf, axis=1)
+        cx = np.take_along_axis(cx, order[:, :, None], axis=1)
+        cf = np.take_along_axis(cf, order, axis=1)
+    return cx, cf, int(nfev)
+
+
+def _local_search(x0, maxiter):
+    res = opt.minimize(_value_and_grad, x0, jac=True,
+                       bounds=sugawara.PARAM_BND, method='L-BFGS-B',
+                       options={'maxiter': maxiter})
+    return res.x, float(res.fun), res.nfev, res.nit
+
+
+class _Evaluator(object):
+    """
+    Evaluates populations of parameter sets, keeping the evaluation count,
+    the best point found so far and the best-so-far objective history.
+    """
+
+    def __init__(self, objective, workers):
+        self.workers = workers
+        self.nfev = 0
+        self.history = []
+        self.best_x = None
+        self.best_fun = np.inf
+        if workers > 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers, initializer=worker.install,
+                initargs=('calibration', objective, sugawara.get_backend()))
+        else:
+            self.pool = None
+            worker.install('calibration', objective, sugawara.get_backend())
+
+    def map(self, fn, *iterables):
+        if self.pool is None:
+            return list(map(fn, *iterables))
+        return list(self.pool.map(fn, *iterables))
+
+    def __call__(self, params):
+        params = np.atleast_2d(params)
+        chunks = np.array_split(params, min(self.workers, len(params)))
+        fun = np.concatenate(self.map(_evaluate_chunk, chunks))
+        self.record(params, fun)
+        return fun
+
+    def record(self, params, fun, nfev=None):
+        self.nfev += len(fun) if nfev is None else nfev
+        i = np.argmin(fun)
+        if fun[i] < self.best_fun:
+            self.best_fun = float(fun[i])
+            self.best_x = np.array(params[i], dtype=float)
+        self.history.append(self.best_fun)
+        if instrument.active():
+            instrument.iteration('calibrate_global', len(self.history),
+                                 self.best_fun, self.best_x)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def latin_hypercube(n, rng, lower=LOWER, upper=UPPER):
+    """n Latin-hypercube points inside the box [lower, upper]."""
+    d = len(lower)
+    u = (rng.random((n, d)) + np.arange(n)[:, None])/n
+    for j in range(d):
+        u[:, j] = u[rng.permutation(n), j]
+    return lower + u*(upper - lower)
+
+
+def _multistart(evaluate, rng, n_starts=None, maxiter=15000):
+    n_starts = n_starts or N_STARTS
+    x0 = latin_hypercube(n_starts, rng)
+    x0[0] = np.clip(sugawara.INITIAL_PARAM, LOWER, UPPER)
+    results = evaluate.map(_local_search, list(x0), [maxiter]*n_starts)
+    for x, fun, nfev, nit in results:
+        evaluate.record(x[None, :], np.array([fun]), nfev)
+    return n_starts
+
+
+def _sce(evaluate, rng, n_complexes=None, max_evals=5000, max_loops=None,
+         peps=1e-3, kstop=10, pcento=1e-4):
+    d = len(LOWER)
+    p = n_complexes or N_COMPLEXES
+    m = 2*d + 1
+    q = d + 1
+    beta = m
+
+    pop = latin_hypercube(p*m, rng)
+    fun = evaluate(pop)
+    order = np.argsort(fun)
+    pop, fun = pop[order], fun[order]
+
+    loops = 0
+    best = [fun[0]]
+    while evaluate.nfev < max_evals:
+        if max_loops is not None and loops >= max_loops:
+            break
+        # Complex k holds the points k, k+p, k+2p, ... of the sorted population
+        cx = np.stack([pop[k::p] for k in range(p)])
+        cf = np.stack([fun[k::p] for k in range(p)])
+        # The complexes evolve apart, one pool task per group of them
+        seeds = rng.integers(2**63 - 1, size=p)
+        groups = np.array_split(np.arange(p), min(evaluate.workers, p))
+        results = evaluate.map(_evolve_complexes, [cx[g] for g in groups],
+                               [cf[g] for g in groups],
+                               [seeds[g] for g in groups],
+                               [beta]*len(groups), [q]*len(groups))
+        cx = np.concatenate([r[0] for r in results])
+        cf = np.concatenate([r[1] for r in results])
+
+        # Shuffle the complexes back into one sorted population
+        pop = cx.reshape(-1, d)
+        fun = cf.reshape(-1)
+        order = np.argsort(fun)
+        pop, fun = pop[order], fun[order]
+        evaluate.record(pop, fun, sum(r[2] for r in results))
+        loops += 1
+
+        best.append(fun[0])
+        gnrng = np.exp(np.mean(np.log((pop.max(axis=0) - pop.min(axis=0))
+                                      /(UPPER - LOWER) + 1e-300)))
+        if gnrng < peps:
+            break
+        if len(best) > kstop:
+            old = best[-kstop - 1]
+            if abs(old - best[-1]) <= pcento*max(abs(old), 1e-12):
+                break
+    return loops
+
+
+def _de(evaluate, rng, popsize=None, max_evals=5000, maxiter=None,
+        mutation=(0.5, 1.0), recombination=0.9, tol=1e-6):
+    d = len(LOWER)
+    n = popsize or 10*d
+    pop = latin_hypercube(n, rng)
+    fun = evaluate(pop)
+
+    gen = 0
+    while evaluate.nfev + n <= max_evals:
+        if maxiter is not None and gen >= maxiter:
+            break
+        # rand/1 donors from three distinct members other than the target
+        r = np.array([rng.choice(np.delete(np.arange(n), i), 3, replace=False)
+                      for i in range(n)])
+        f = rng.uniform(*mutation)
+        donor = pop[r[:, 0]] + f*(pop[r[:, 1]] - pop[r[:, 2]])
+        donor = np.clip(donor, LOWER, UPPER)
+
+        cross = rng.random((n, d)) < recombination
+        cross[np.arange(n), rng.integers(d, size=n)] = True
+        trial = np.where(cross, donor, pop)
+        trial_f = evaluate(trial)
+
+        better = trial_f <= fun
+        pop[better] = trial[better]
+        fun[better] = trial_f[better]
+        gen += 1
+        if np.std(fun) <= tol*max(abs(np.mean(fun)), 1e-12):
+            break
+    return gen
+
+
+_STRATEGIES = {'multistart': _multistart, 'sce': _sce, 'de': _de}
+
+
+def calibrate_global(prec, evap, extra_param, q_rec, method='sce', seed=0,
+                     workers=None, **options):
+    """
+    Calibrates the model with a global strategy.
+
+    prec, evap, extra_param, q_rec -> as in sugawara.calibrate
+    method -> 'multistart', 'sce' or 'de'
+    seed -> seed of the random generator, results are reproducible
+    workers -> size of the process pool, default is one per core
+    options -> strategy settings (max_evals, n_starts, n_complexes, popsize,
+               maxiter, ...)
+
+    Returns a scipy OptimizeResult with the best parameters (x), objective
+    (fun, the negative NSE), the best-so-far objective after every
+    iteration (history), the number of objective evaluations (nfev), the
+    number of iterations (nit), the wall-clock time in seconds (wall_time)
+    and the number of workers used. Results are kept in cache.CACHE, so a
+    repeated call with the same data and settings returns immediately.
+    """
+    if method not in _STRATEGIES:
+        raise ValueError("method must be one of %s, got %r"
+                         % (', '.join(METHODS), method))
+    workers = workers or default_workers()
+    objective = Objective(prec, evap, extra_param, q_rec)
+    result_key = objective.result_key('calibrate_global', method, seed,
+                                      options)
+    cached = CACHE.get(result_key)
+    if cached is not None:
+        return cached
+    rng = np.random.default_rng(seed)
+
+    start = time.perf_counter()
+    evaluate = _Evaluator(objective, workers)
+    try:
+        nit = _STRATEGIES[method](evaluate, rng, **options)
+    finally:
+        evaluate.close()
+    wall_time = time.perf_counter() - start
+
+    res = opt.OptimizeResult(x=evaluate.best_x, fun=evaluate.best_fun,
+                             history=np.array(evaluate.history),
+                             nfev=evaluate.nfev, nit=nit,
+                             wall_time=wall_time, workers=workers,
+                             method=method, success=True)
+    CACHE.put(result_key, res)
+    return res
+
+
+def recency_weights(n_steps, halflife):
+    """Weights(n_steps) halving every halflife steps back from the last."""
+    return 0.5**((n_steps - 1 - np.arange(n_steps))/float(halflife))
+
+
+def _window_state(prec, evap, extra_param, param, start, checkpoint):
+    # State after `start` steps under param, advanced from the checkpoint
+    # when it lies before the window and holds the states of the same
+    # parameters (or does not say), otherwise from the beginning of the
+    # record
+    n_done, state = 0, None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        states, n_steps, saved = sugawara.load_checkpoint(checkpoint)
+        if n_steps <= start and (saved is None
+                                 or np.array_equal(saved, param)):
+            n_done, state = n_steps, states
+    if n_done < start:
+        state = sugawara.simulate(prec[n_done:start], evap[n_done:start],
+                                  param, extra_param, return_states=False,
+                                  initial_states=state)[1]
+    if state is None:
+        state = np.array(sugawara.INITIAL_STATES, dtype=float)
+    return state, start - n_done
+
+
+def recalibrate(prec, evap, extra_param, q_rec, previous, window=None,
+                halflife=None, checkpoint=None, maxiter=30, moved_tol=0.01):
+    """
+    Warm-started recalibration after new records are appended.
+
+    prec, evap, extra_param, q_rec -> the whole record, as in
+                                      sugawara.calibrate
+    previous -> the previous optimum, a parameter vector or a result
+    window -> calibrate on the last window time steps only, starting from
+              the model states at the window start
+    halflife -> weight the time steps by recency_weights(halflife)
+    checkpoint -> .npz file of sugawara.save_checkpoint holding the states
+                  at the previous window start and the parameters that
+                  produced them; when these are the previous optimum the
+                  states at the new window start are advanced from it
+                  over the appended steps only. The states under the new
+                  optimum are written back to it (simulated again up to
+                  the window start when the optimum changed)
+    maxiter -> L-BFGS-B iterations of the refinement
+    moved_tol -> largest parameter change, as a fraction of the PARAM_BND
+                 range, still counted as the same optimum
+
+    Returns a scipy OptimizeResult with x and fun as calibrate_global, the
+    previous optimum and its objective on the same data (x_previous,
+    fun_previous), the largest scaled parameter change (shift), whether
+    the optimum moved, the window start, the number of steps simulated to
+    reach it (n_advanced), nfev, nit and wall_time.
+    """
+    start_time = time.perf_counter()
+    x0 = np.asarray(getattr(previous, 'x', previous), dtype=float)
+    prec = np.asarray(prec, dtype=float)
+    evap = np.asarray(evap, dtype=float)
+    q_rec = np.asarray(q_rec, dtype=float)
+    n_steps = len(q_rec)
+    start = 0 if window is None else max(n_steps - window, 0)
+
+    state, n_advanced = _window_state(prec, evap, extra_param, x0, start,
+                                      checkpoint)
+    weights = None
+    if halflife is not None:
+        weights = recency_weights(n_steps - start, halflife)
+    if start > 0:
+        # The first simulated value is the dummy initial flow
+        weights = np.ones(n_steps - start) if weights is None else weights
+        weights[0] = 0.0
+    objective = Objective(prec[start:], evap[start:], extra_param,
+                          q_rec[start:], weights=weights,
+                          initial_states=state)
+
+    fun_previous = objective(x0)
+    callback = instrument.optimizer_callback(
+        'recalibrate', lambda param: objective.value_and_grad(param)[0])
+    res = opt.minimize(objective.value_and_grad,
+                       np.clip(x0, LOWER, UPPER), jac=True,
+                       bounds=sugawara.PARAM_BND, method='L-BFGS-B',
+                       callback=callback, options={'maxiter': maxiter})
+    if res.fun > fun_previous:
+        res.x, res.fun = x0, fun_previous
+    if checkpoint is not None:
+        if not np.array_equal(res.x, x0):
+            # The states were simulated with x0, the checkpoint has to
+            # hold those of the parameters saved with it
+            state = _window_state(prec, evap, extra_param, res.x, start,
+                                  None)[0]
+        sugawara.save_checkpoint(checkpoint, state, start, res.x)
+
+    shift = float(np.max(np.abs(res.x - x0)/(UPPER - LOWER)))
+    return opt.OptimizeResult(x=res.x, fun=float(res.fun), x_previous=x0,
+                              fun_previous=float(fun_previous), shift=shift,
+                              moved=shift > moved_tol, window_start=start,
+                              n_advanced=n_advanced, nfev=res.nfev,
+                              nit=res.nit, success=res.success,
+                              wall_time=time.perf_counter() - start_time)
+
+
+class Cancelled(Exception):
+    """Raised inside the optimizer when a CalibrationJob is cancelled."""
+
+
+class CalibrationJob(object):
+    """
+    L-BFGS-B calibration (as sugawara.calibrate) running in the background.
+
+    The optimizer loop runs in a thread of the calling process while every
+    objective evaluation runs in a dedicated worker process, so the thread
+    mostly waits on futures and does not hold the interpreter lock. Several
+    jobs can run side by side in one server process.
+
+    progress -> optional callable(iteration, nse, param, q_sim) called from
+                the job thread at most once every min_interval seconds with
+                the current best point and its simulated flow; the final
+                point is always reported
+    done -> optional callable(job) called from the job thread at the end,
+            whether the job finished, failed or was cancelled
+
+    Finished results are kept in cache.CACHE; a job on data and settings
+    already calibrated reports the stored optimum without optimizing.
+    """
+
+    def __init__(self, prec, evap, extra_param, q_rec, progress=None,
+                 done=None, min_interval=0.5, maxiter=15000):
+        self.objective = Objective(prec, evap, extra_param, q_rec)
+        self.progress = progress
+        self.done = done
+        self.min_interval = min_interval
+        self.maxiter = maxiter
+        self.result = None
+        self.error = None
+        self.iteration = 0
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._pool = None
+        self._last_report = -np.inf
+
+    def start(self):
+        self._pool = ProcessPoolExecutor(max_workers=1,
+                                         initializer=worker.install,
+                                         initargs=('calibration',
+                                                   self.objective))
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Stops the job at the next objective evaluation."""
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def running(self):
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    @instrument.timed('CalibrationJob.fun')
+    def _fun(self, param):
+        if self._cancel.is_set():
+            raise Cancelled()
+        return self._pool.submit(_value_and_grad, param).result()
+
+    def _callback(self, xk):
+        self.iteration += 1
+        if instrument.active():
+            # Memoized by the worker's Objective
+            fun = self._pool.submit(_value_and_grad, xk).result()[0]
+            instrument.iteration('CalibrationJob', self.iteration, fun, xk)
+        now = time.perf_counter()
+        if now - self._last_report >= self.min_interval:
+            self._report(xk)
+
+    def _report(self, param):
+        self._last_report = time.perf_counter()
+        if self.progress is None:
+            return
+        fun = self._pool.submit(_value_and_grad, param).result()[0]
+        q_sim = self._pool.submit(_simulate_flow, param).result()
+        self.progress(self.iteration, -fun, np.array(param), q_sim)
+
+    def _run(self):
+        try:
+            # Same key as sugawara.calibrate(..., maxiter=maxiter)
+            result_key = self.objective.result_key(
+                'calibrate', sugawara.INITIAL_PARAM, {'maxiter': self.maxiter})
+            res = CACHE.get(result_key)
+            if res is None:
+                res = opt.minimize(self._fun, sugawara.INITIAL_PARAM,
+                                   jac=True, bounds=sugawara.PARAM_BND,
+                                   method='L-BFGS-B', callback=self._callback,
+                                   options={'maxiter': self.maxiter})
+                CACHE.put(result_key, res)
+            self.result = res
+            self._report(res.x)
+        except Cancelled:
+            pass
+        except Exception as err:
+            self.error = err
+        finally:
+            self._pool.shutdown(wait=False)
+            if self.done is not None:
+                self.done(self)
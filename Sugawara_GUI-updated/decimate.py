@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side downsampling of long time series for plotting
+
+minmax returns indices into the original arrays, so the x values and
+every column sharing them can be sliced with one fancy index.
+"""
+from __future__ import division
+import numpy as np
+
+
+def window(x, start=None, end=None, margin=1.0):
+    """
+    Index range [i0, i1) of the sorted array x inside [start, end],
+    widened by margin times the window width on each side so that small
+    pans do not show empty areas before the next update arrives.
+    """
+    if start is None or end is None or not np.isfinite([start, end]).all():
+        return 0, len(x)
+    width = (end - start)*margin
+    i0 = np.searchsorted(x, start - width, side='left')
+    i1 = np.searchsorted(x, end + width, side='right')
+    return i0, i1
+
+
+def minmax(y, n_out, i0=0, i1=None):
+    """
+    Indices of the minimum and maximum of y in each of n_out//2 equal
+    bins of y[i0:i1], plus the first and last sample. Peaks and troughs
+    survive, which is what matters on hydrographs.
+    """
+    i1 = len(y) if i1 is None else i1
+    n = i1 - i0
+    if n <= n_out:
+        return np.arange(i0, i1)
+    n_bins = max(n_out//2, 1)
+    size = -(-n//n_bins)
+    pad = n_bins*size - n
+    seg = np.asarray(y[i0:i1], dtype=float)
+    if pad:
+        seg = np.concatenate((seg, np.full(pad, seg[-1])))
+    seg = np.where(np.isnan(seg), 0.0, seg).reshape(n_bins, size)
+    base = np.arange(n_bins)*size
+    idx = np.concatenate(([0, n - 1], base + seg.argmin(axis=1),
+                          base + seg.argmax(axis=1)))
+    return i0 + np.unique(np.minimum(idx, n - 1))
+
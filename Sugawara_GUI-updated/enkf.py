@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Ensemble Kalman filter forecasting mode for the Sugawara tank model
+
+Every member carries the tank levels S1, S2 and, optionally, its own
+parameter vector. Members are advanced together with
+sugawara._step_batch. When a flow observation arrives, the flow each
+member computes with the _step flow equation is used as the predicted
+observation, and the states (and parameters) are updated with perturbed
+observations (Evensen 2003). Forecasts are then run from a copy of the
+analysed ensemble over the forcing of the lead time.
+
+Update latency is measured on every assimilation. With latency_budget
+set, an update that overruns the budget halves the ensemble, down to
+min_members, so later updates fit in the budget.
+"""
+from __future__ import division
+import time
+
+import numpy as np
+
+import sugawara
+from sugawara import LOWER, UPPER
+
+
+class EnsembleKalmanFilter(object):
+    """
+    param -> central parameter vector, e.g. from sugawara.calibrate
+    extra_param -> [DT, AREA]
+    n_members -> ensemble size
+    states -> initial [S1, S2], INITIAL_STATES by default
+    state_spread -> relative spread of the initial states
+    param_spread -> spread of the initial parameters, as a fraction of the
+                    PARAM_BND range; 0 keeps one parameter set
+    estimate_params -> update the parameters along with the states; this
+                       sharpens the first lead times but lets parameters
+                       drift on short records, so it is off by default
+    obs_error -> relative standard deviation of the flow observations
+    obs_error_min -> lower bound of that standard deviation [m3/s]
+    state_noise -> relative model error added to the states every step
+    param_noise -> random walk of the parameters every step, as a
+                   fraction of the PARAM_BND range
+    latency_budget -> seconds allowed per assimilation, None for no bound
+    min_members -> smallest ensemble the budget may shrink to
+    seed -> seed of the random generator
+    """
+
+    def __init__(self, param, extra_param, n_members=500, states=None,
+                 state_spread=0.2, param_spread=0.0, estimate_params=False,
+                 obs_error=0.1, obs_error_min=0.01, state_noise=0.05,
+                 param_noise=0.005, latency_budget=None, min_members=50,
+                 seed=0):
+        self.extra_param = list(extra_param)
+        self.estimate_params = estimate_params
+        self.obs_error = obs_error
+        self.obs_error_min = obs_error_min
+        self.state_noise = state_noise
+        self.param_noise = param_noise
+        self.latency_budget = latency_budget
+        self.min_members = min_members
+        self.rng = np.random.default_rng(seed)
+        self.latencies = []
+        self.q = None
+
+        if states is None:
+            states = sugawara.INITIAL_STATES
+        states = np.asarray(states, dtype=float)
+        param = np.asarray(param, dtype=float)
+        # Members are columns: rows 0-1 the states, rows 2-9 the parameters
+        self.members = np.empty((10, n_members))
+        self.members[:2] = np.maximum(states[:, None]*(
+            1 + state_spread*self.rng.standard_normal((2, n_members))), 0.0)
+        self.members[2:] = param[:, None] + (param_spread*(UPPER - LOWER))[
+            :, None]*self.rng.standard_normal((8, n_members))
+        self._clip()
+
+    @property
+    def n_members(self):
+        return self.members.shape[1]
+
+    @property
+    def states(self):
+        """Member states(2, N)."""
+        return self.members[:2]
+
+    @property
+    def params(self):
+        """Member parameters(8, N)."""
+        return self.members[2:]
+
+    def _clip(self):
+        np.maximum(self.members[:2], 0.0, out=self.members[:2])
+        np.clip(self.members[2:], LOWER[:, None], UPPER[:, None],
+                out=self.members[2:])
+
+    def predict(self, prec, evap):
+        """
+        Advances every member one time step and adds the model error.
+        Returns the flow of every member(N), the predicted observation.
+        """
+        m = self.members
+        self.q, m[0], m[1] = sugawara._step_batch(prec, evap, m[0], m[1],
+                                                  m[2:], self.extra_param)
+        n = self.n_members
+        if self.state_noise:
+            m[:2] *= np.exp(self.state_noise*self.rng.standard_normal((2, n)))
+        if self.estimate_params and self.param_noise:
+            m[2:] += (self.param_noise*(UPPER - LOWER))[:, None] \
+                * self.rng.standard_normal((8, n))
+        self._clip()
+        return self.q
+
+    def update(self, q_obs):
+        """
+        Assimilates the flow observation of the last predicted step.
+        Returns the analysed flow of every member(N); a missing (NaN)
+        observation leaves the ensemble unchanged.
+        """
+        if not np.isfinite(q_obs):
+            return self.q
+        n = self.n_members
+        sd = max(self.obs_error*abs(q_obs), self.obs_error_min)
+        rows = 10 if self.estimate_params else 2
+        z = self.members[:rows]
+        hx = self.q
+        dz = z - z.mean(axis=1, keepdims=True)
+        dh = hx - hx.mean()
+        var_h = np.dot(dh, dh)/(n - 1)
+        gain = np.dot(dz, dh)/(n - 1)/(var_h + sd*sd)
+        innov = q_obs + sd*self.rng.standard_normal(n) - hx
+        z += gain[:, None]*innov
+        self._clip()
+        self.q = hx + var_h/(var_h + sd*sd)*innov
+        return self.q
+
+    def forecast(self, prec, evap):
+        """
+        Flow of every member over the forcing arrays(L) of the lead time,
+        from a copy of the current ensemble. Returns an array(L, N).
+        """
+        m = self.members
+        s1, s2 = m[0].copy(), m[1].copy()
+        q = np.empty((len(prec), self.n_members))
+        for i in range(len(prec)):
+            q[i], s1, s2 = sugawara._step_batch(prec[i], evap[i], s1, s2,
+                                                m[2:], self.extra_param)
+        return q
+
+    def assimilate(self, prec, evap, q_obs, prec_lead=None, evap_lead=None):
+        """
+        One filter cycle: predict with the forcing of the step, update with
+        its flow observation and, if lead-time forcing is given, forecast.
+        Returns the analysed flow(N) and the forecast(L, N) or None. The
+        wall-clock time of the cycle is appended to latencies.
+        """
+        start = time.perf_counter()
+        self.predict(prec, evap)
+        q = self.update(q_obs)
+        fc = None
+        if prec_lead is not None and len(prec_lead):
+            fc = self.forecast(prec_lead, evap_lead)
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        if self.latency_budget is not None and latency > self.latency_budget:
+            self._shrink()
+        return q, fc
+
+    def _shrink(self):
+        n = max(self.n_members//2, self.min_members)
+        if n < self.n_members:
+            keep = self.rng.choice(self.n_members, n, replace=False)
+            self.members = self.members[:, keep]
+            self.q = self.q[keep]
+
+    def latency_stats(self):
+        """Median, 99th percentile and maximum latency in seconds."""
+        lat = np.asarray(self.latencies)
+        if not len(lat):
+            return {'p50': None, 'p99': None, 'max': None}
+        return {'p50': float(np.percentile(lat, 50)),
+                'p99': float(np.percentile(lat, 99)),
+                'max': float(lat.max())}
+
+
+def run(prec, evap, q_obs, param, extra_param, lead=24,
+        quantiles=(0.05, 0.5, 0.95), **options):
+    """
+    Replays a record through the filter, as an operational hindcast with
+    the recorded forcing used over the lead time.
+
+    prec, evap, q_obs -> arrays(T) aligned as in sugawara.calibrate
+    param, extra_param -> model parameters
+    lead -> forecast length in time steps
+    options -> EnsembleKalmanFilter settings
+
+    Returns a dict with the analysed mean flow(T), the forecast quantiles
+    (T, lead, len(quantiles)) issued at every step (NaN past the record
+    end), the filter and its latency statistics.
+    """
+    enkf = EnsembleKalmanFilter(param, extra_param, **options)
+    n_steps = len(q_obs)
+    analysis = np.full(n_steps, np.nan)
+    bands = np.full((n_steps, lead, len(quantiles)), np.nan)
+    q = np.asarray(quantiles)
+    for t in range(1, n_steps):
+        q_an, fc = enkf.assimilate(prec[t - 1], evap[t - 1], q_obs[t],
+                                   prec[t:t + lead], evap[t:t + lead])
+        analysis[t] = q_an.mean()
+        if fc is not None:
+            bands[t, :len(fc)] = np.quantile(fc, q, axis=1).T
+    return {'analysis': analysis, 'forecast': bands, 'quantiles': q,
+            'filter': enkf, 'latency': enkf.latency_stats()}
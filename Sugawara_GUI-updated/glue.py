@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+GLUE / Monte Carlo uncertainty analysis for the Sugawara tank model
+
+Parameter sets are drawn inside PARAM_BND (Latin hypercube or Sobol),
+simulated in chunks with sugawara.simulate_batch on a process pool, and
+scored with NSE. Sets at or above the NSE threshold are behavioural and
+weighted by (NSE - threshold)**shape. Prediction bands are weighted
+quantiles of the behavioural flows at every time step.
+
+Memory stays bounded: a worker holds one chunk of simulations at a time.
+The first pass keeps only the scores and the per-time-step envelope of
+the behavioural flows. The second pass re-simulates the behavioural sets
+and adds them into weighted histograms, n_bins per time step between
+those envelopes. The quantiles are read from the histograms, so their
+resolution is (max - min)/n_bins at each step.
+"""
+from __future__ import division
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import sugawara
+import metrics
+import worker
+from calibration import latin_hypercube
+from sugawara import LOWER, UPPER
+from worker import default_workers
+
+
+def sample(n, method='lhs', seed=0):
+    """
+    n parameter sets(n, 8) inside PARAM_BND.
+    method -> 'lhs' (Latin hypercube) or 'sobol' (scrambled Sobol sequence,
+              needs scipy >= 1.7)
+    """
+    rng = np.random.default_rng(seed)
+    if method == 'lhs':
+        return latin_hypercube(n, rng)
+    if method == 'sobol':
+        from scipy.stats import qmc
+        u = qmc.Sobol(len(LOWER), scramble=True, seed=rng).random(n)
+        return LOWER + u*(UPPER - LOWER)
+    raise ValueError("method must be 'lhs' or 'sobol', got %r" % method)
+
+
+def _simulate(params):
+    data = worker.STATE['glue']
+    return sugawara.simulate_batch(data['prec'], data['evap'], params,
+                                   data['extra_param'],
+                                   return_states=False)[0]
+
+
+def _score_chunk(params, threshold):
+    data = worker.STATE['glue']
+    q_sim = _simulate(params)
+    nse = metrics.nse(q_sim, data['q_obs'], data['warmup'])
+    beh = nse >= threshold
+    if not beh.any():
+        return nse, None, None
+    return nse, q_sim[:, beh].min(axis=1), q_sim[:, beh].max(axis=1)
+
+
+def _hist_chunk(params, weights, lo, width, n_bins):
+    q_sim = _simulate(params)
+    n_steps = q_sim.shape[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pos = (q_sim - lo[:, None])/width[:, None]
+    pos = np.where(np.isfinite(pos), pos, 0.0)
+    idx = np.clip(pos.astype(np.int64), 0, n_bins - 1)
+    idx += (np.arange(n_steps)*n_bins)[:, None]
+    hist = np.bincount(idx.ravel(), weights=np.broadcast_to(
+        weights, q_sim.shape).ravel(), minlength=n_steps*n_bins)
+    return hist.reshape(n_steps, n_bins)
+
+
+def _quantiles(hist, lo, width, quantiles):
+    total = hist.sum(axis=1, keepdims=True)
+    cdf = np.cumsum(hist, axis=1)/total
+    bands = np.empty((len(quantiles), hist.shape[0]))
+    rows = np.arange(hist.shape[0])
+    for k, q in enumerate(quantiles):
+        # Linear interpolation inside the bin where the cdf reaches q
+        b = np.minimum((cdf < q).sum(axis=1), hist.shape[1] - 1)
+        below = np.where(b > 0, cdf[rows, np.maximum(b - 1, 0)], 0.0)
+        in_bin = hist[rows, b]/total[:, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(in_bin > 0, (q - below)/in_bin, 0.0)
+        bands[k] = lo + (b + np.clip(frac, 0.0, 1.0))*width
+    return bands
+
+
+def glue(prec, evap, extra_param, q_obs, n_samples=10000, threshold=0.5,
+         quantiles=(0.05, 0.5, 0.95), method='lhs', seed=0, warmup=0,
+         shape=1.0, n_bins=200, chunk_size=500, workers=None, params=None):
+    """
+    Runs a GLUE analysis.
+
+    prec, evap, extra_param, q_obs -> as in sugawara.calibrate; the model
+                                      runs on prec[:-1] and evap[:-1]
+    n_samples, method, seed -> sampling of the parameter sets, ignored if
+                               params(N, 8) are given
+    threshold -> NSE threshold of the behavioural sets
+    quantiles -> probabilities of the prediction bands
+    warmup -> time steps excluded from NSE
+    shape -> likelihood weights are (NSE - threshold)**shape
+    n_bins -> histogram bins per time step for the quantiles
+    chunk_size -> parameter sets simulated at once by a worker
+    workers -> size of the process pool, default is one per core
+
+    Returns a dict with the sampled params, their nse, the behavioural
+    mask, the normalised weights of the behavioural sets, the bands
+    array(len(quantiles), T) (None if no set is behavioural), the
+    behavioural flow envelope (lower, upper), the number of simulations
+    run and the wall-clock time.
+    """
+    start = time.perf_counter()
+    if params is None:
+        params = sample(n_samples, method, seed)
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    workers = workers or default_workers()
+    data = {'prec': np.asarray(prec, dtype=float)[:-1],
+            'evap': np.asarray(evap, dtype=float)[:-1],
+            'extra_param': list(extra_param),
+            'q_obs': np.asarray(q_obs, dtype=float), 'warmup': warmup}
+    chunks = [params[i:i + chunk_size]
+              for i in range(0, len(params), chunk_size)]
+
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=worker.install,
+                                   initargs=('glue', data))
+        pmap = pool.map
+    else:
+        pool = None
+        worker.install('glue', data)
+        pmap = map
+
+    try:
+        # Pass 1: scores and behavioural envelope
+        nse = []
+        lower = upper = None
+        for c_nse, c_lo, c_hi in pmap(_score_chunk, chunks,
+                                      [threshold]*len(chunks)):
+            nse.append(c_nse)
+            if c_lo is not None:
+                lower = c_lo if lower is None else np.minimum(lower, c_lo)
+                upper = c_hi if upper is None else np.maximum(upper, c_hi)
+        nse = np.concatenate(nse)
+        behavioural = nse >= threshold
+        n_runs = len(params)
+
+        weights = (nse[behavioural] - threshold)**shape
+        if weights.sum() > 0:
+            weights = weights/weights.sum()
+        elif behavioural.any():
+            weights = np.full(behavioural.sum(), 1.0/behavioural.sum())
+
+        # Pass 2: weighted histograms of the behavioural flows
+        bands = None
+        if behavioural.any():
+            width = (upper - lower)/n_bins
+            beh_params = params[behavioural]
+            beh_chunks = [(beh_params[i:i + chunk_size],
+                           weights[i:i + chunk_size])
+                          for i in range(0, len(beh_params), chunk_size)]
+            hist = None
+            for part in pmap(_hist_chunk, [c[0] for c in beh_chunks],
+                             [c[1] for c in beh_chunks],
+                             [lower]*len(beh_chunks), [width]*len(beh_chunks),
+                             [n_bins]*len(beh_chunks)):
+                hist = part if hist is None else hist + part
+            n_runs += len(beh_params)
+            bands = _quantiles(hist, lower, width, quantiles)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return {'params': params, 'nse': nse, 'behavioural': behavioural,
+            'weights': weights, 'quantiles': np.asarray(quantiles),
+            'bands': bands, 'lower': lower, 'upper': upper,
+            'n_runs': n_runs, 'wall_time': time.perf_counter() - start}
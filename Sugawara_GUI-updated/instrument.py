@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the model, the calibration and the GUI
+
+Timers and counters wrap sugawara.simulate, simulate_batch and
+simulate_sens (the loops over _step), the calibration objective and the
+samp1 callbacks. Within the callbacks, gui.read_asc and gui.read_params
+time the file parsing, the simulate timers the model runs and gui.send
+the ColumnDataSource updates, where Bokeh serializes the document patch.
+While instrumentation is off, which is the default, a timed function
+costs one extra call and a flag test, and timer() returns a shared no-op
+context.
+
+    import instrument
+    instrument.enable()
+    ...
+    print(instrument.stats()['simulate'])
+    instrument.export('profile.trace.json')     # chrome://tracing, Perfetto
+
+Setting SUGAWARA_INSTRUMENT=1 enables it at import; a file name instead
+also exports there at exit (a Chrome trace when it ends in .trace.json,
+the statistics as JSON otherwise). Worker processes started afterwards
+inherit the variable but keep their own statistics.
+
+Optimizer hooks, added with add_hook, are called as hook(source,
+iteration, fun, param) after every iteration of sugawara.calibrate,
+calibration.calibrate_global, recalibrate and CalibrationJob. They run
+even while timers are off.
+"""
+from __future__ import division
+import atexit
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+MAX_EVENTS = 100000
+
+_state = {'enabled': False, 'hooks': [], 'origin': time.perf_counter()}
+_lock = threading.Lock()
+_timers = {}
+_counters = collections.Counter()
+_events = collections.deque(maxlen=MAX_EVENTS)
+
+
+def enable(on=True):
+    """Turns the timers and counters on (or off with on=False)."""
+    _state['enabled'] = bool(on)
+
+
+def disable():
+    enable(False)
+
+
+def enabled():
+    return _state['enabled']
+
+
+def reset():
+    """Clears the statistics and the trace events."""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _events.clear()
+    _state['origin'] = time.perf_counter()
+
+
+# Timers and counters
+
+def count(name, n=1):
+    """Adds n to the counter name."""
+    if _state['enabled']:
+        with _lock:
+            _counters[name] += n
+
+
+def _record(name, start, items):
+    end = time.perf_counter()
+    elapsed = end - start
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, float('inf'), 0.0, 0]
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = min(timer[2], elapsed)
+        timer[3] = max(timer[3], elapsed)
+        timer[4] += items
+        _events.append(('X', name, start, elapsed, threading.get_ident(),
+                        items))
+
+
+class _Timer(object):
+    __slots__ = ('name', 'items', 'start')
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.start, self.items)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullTimer()
+
+
+def timer(name, items=0):
+    """
+    Context manager timing its block under name; items (time steps,
+    parameter sets, ...) are summed for throughput.
+    """
+    if _state['enabled']:
+        return _Timer(name, items)
+    return _NULL
+
+
+def timed(name, items=None):
+    """
+    Decorator timing every call under name. items -> optional callable
+    receiving the call's arguments and returning its number of items,
+    only called while instrumentation is on.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _record(name, start,
+                        0 if items is None else items(*args, **kwargs))
+        return wrapper
+    return decorate
+
+
+# Optimizer hooks
+
+def add_hook(hook):
+    """Registers hook(source, iteration, fun, param)."""
+    _state['hooks'].append(hook)
+
+
+def remove_hook(hook):
+    _state['hooks'].remove(hook)
+
+
+def active():
+    """True when iterations are being recorded or hooked."""
+    return _state['enabled'] or bool(_state['hooks'])
+
+
+def iteration(source, i, fun, param):
+    """Reports iteration i of an optimizer to the hooks and the trace."""
+    if _state['enabled']:
+        with _lock:
+            _counters[source + '.iterations'] += 1
+            _events.append(('C', source, time.perf_counter(), float(fun),
+                            threading.get_ident(), i))
+    for hook in list(_state['hooks']):
+        hook(source, i, fun, param)
+
+
+def optimizer_callback(source, fun):
+    """
+    scipy.optimize callback(xk) reporting every iteration, with the
+    objective fun(xk) (memoized by calibration.Objective), or None when
+    nothing listens, so the optimizer runs without a callback.
+    """
+    if not active():
+        return None
+    counter = [0]
+
+    def callback(xk):
+        counter[0] += 1
+        iteration(source, counter[0], fun(xk), xk)
+    return callback
+
+
+# Results
+
+def stats():
+    """
+    {name: {count, total, mean, min, max, items, items_per_s}} of the
+    timers, plus {name: value} of the counters.
+    """
+    result = {}
+    with _lock:
+        for name, (n, total, low, high, items) in _timers.items():
+            result[name] = {'count': n, 'total': total, 'mean': total/n,
+                            'min': low, 'max': high, 'items': items,
+                            'items_per_s': items/total if total else None}
+        result.update(_counters)
+    return result
+
+
+def summary():
+    """Table of the timers, slowest total first."""
+    timers = [(name, s) for name, s in stats().items() if isinstance(s, dict)]
+    lines = ['%-28s %8s %10s %10s %10s' % ('timer', 'count', 'total s',
+                                            'mean ms', 'max ms')]
+    for name, s in sorted(timers, key=lambda t: -t[1]['total']):
+        lines.append('%-28s %8d %10.3f %10.3f %10.3f' % (
+            name, s['count'], s['total'], 1e3*s['mean'], 1e3*s['max']))
+    return '\n'.join(lines)
+
+
+def trace():
+    """Trace events in the Chrome trace event format (times in us)."""
+    origin = _state['origin']
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+    trace = []
+    for kind, name, start, value, tid, extra in events:
+        if kind == 'X':
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                     'ts': 1e6*(start - origin), 'dur': 1e6*value}
+            if extra:
+                event['args'] = {'items': extra}
+        else:
+            event = {'name': name, 'ph': 'C', 'ts': 1e6*(start - origin),
+                     'args': {'fun': value}}
+        event.update(pid=pid, tid=tid)
+        trace.append(event)
+    return trace
+
+
+def export(fname, chrome=None):
+    """
+    Writes the statistics as JSON, or a Chrome trace (with the statistics
+    in otherData) when chrome is True or fname ends in .trace.json.
+    """
+    if chrome is None:
+        chrome = fname.endswith('.trace.json')
+    if chrome:
+        data = {'traceEvents': trace(), 'displayTimeUnit': 'ms',
+                'otherData': stats()}
+    else:
+        data = stats()
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=None if chrome else 1)
+    os.replace(tmp, fname)
+    return fname
+
+
+def _from_environment():
+    value = os.environ.get('SUGAWARA_INSTRUMENT', '')
+    if value and value != '0':
+        enable()
+        if value != '1':
+            atexit.register(export, value)
+            # Worker processes only enable, the file is this process's
+            os.environ['SUGAWARA_INSTRUMENT'] = '1'
+
+
+_from_environment()
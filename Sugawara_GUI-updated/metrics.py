@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Performance metrics for simulated against recorded flow
+
+Every function takes the simulated flow sim as an array(T) or as an
+ensemble array(T, N), one column per member, and the record obs(T). The
+first `warmup` time steps are excluded and, per member, any time step
+where obs or sim is NaN is masked out. Ensemble inputs give one value per
+member, so thousands of simulations are scored in one call.
+
+The HBVX .asc header values are reproduced with warmup=100,
+low_threshold=5.0 and peak_threshold=25.0.
+"""
+from __future__ import division
+import numpy as np
+
+
+def _prepare(sim, obs, warmup):
+    sim = np.asarray(sim, dtype=float)[warmup:]
+    obs = np.asarray(obs, dtype=float)[warmup:]
+    if sim.ndim == 2:
+        obs = obs[:, None]
+    mask = np.isfinite(sim) & np.isfinite(obs)
+    if mask.all():
+        # No gaps: plain sums, no masking temporaries
+        mask = None
+    return sim, obs, mask
+
+
+def _and(mask, cond, shape):
+    cond = np.broadcast_to(cond, shape)
+    return cond if mask is None else mask & cond
+
+
+def _msum(x, mask):
+    if mask is None:
+        return x.sum(axis=0)
+    return np.where(mask, x, 0.0).sum(axis=0)
+
+
+def _count(x, mask):
+    return x.shape[0] if mask is None else mask.sum(axis=0)
+
+
+def _mmean(x, mask):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _msum(x, mask)/_count(x, mask)
+
+
+def _nse(sim, obs, mask):
+    err = sim - obs
+    dev = obs - _mmean(obs*np.ones_like(sim), mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1.0 - _msum(err*err, mask)/_msum(dev*dev, mask)
+
+
+def _rmse(err, mask, weights=None):
+    if weights is None:
+        return np.sqrt(_mmean(err*err, mask))
+    weights = weights*np.ones_like(err)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(_msum(weights*err*err, mask)/_msum(weights, mask))
+
+
+def nse(sim, obs, warmup=0):
+    """Nash-Sutcliffe efficiency."""
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    return _nse(sim, obs, mask)
+
+
+def log_nse(sim, obs, warmup=0, eps=None):
+    """
+    NSE of the log flows, weighting low flows. eps is added before taking
+    logs; by default 1% of the mean observed flow.
+    """
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    if eps is None:
+        eps = 0.01*np.nanmean(obs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lsim = np.log(sim + eps)
+        lobs = np.log(obs + eps)
+    return _nse(lsim, lobs, _and(mask, np.isfinite(lsim) & np.isfinite(lobs),
+                                 lsim.shape))
+
+
+def rmse(sim, obs, warmup=0, weights=None):
+    """
+    Root mean squared error; with weights(T) the weighted RMSE
+    sqrt(sum(w*e**2)/sum(w)). Unit weights give the HBVX weighted RMSE.
+    """
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[warmup:]
+        if sim.ndim == 2:
+            weights = weights[:, None]
+    return _rmse(sim - obs, mask, weights)
+
+
+def kge(sim, obs, warmup=0):
+    """Kling-Gupta efficiency (Gupta et al. 2009)."""
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    obs = obs*np.ones_like(sim)
+    ms = _mmean(sim, mask)
+    mo = _mmean(obs, mask)
+    ds = sim - ms
+    do = obs - mo
+    ss = np.sqrt(_mmean(ds*ds, mask))
+    so = np.sqrt(_mmean(do*do, mask))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = _mmean(ds*do, mask)/(ss*so)
+        return 1.0 - np.sqrt((r - 1)**2 + (ss/so - 1)**2 + (ms/mo - 1)**2)
+
+
+def low_flow_rmse(sim, obs, warmup=0, threshold=None):
+    """RMSE over the time steps with obs below threshold (default: mean obs)."""
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    if threshold is None:
+        threshold = np.nanmean(obs)
+    return _rmse(sim - obs, _and(mask, obs < threshold, sim.shape))
+
+
+def peak_flow_rmse(sim, obs, warmup=0, threshold=None):
+    """
+    RMSE over the time steps with obs above threshold (default: mean obs
+    plus two standard deviations).
+    """
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    if threshold is None:
+        threshold = np.nanmean(obs) + 2*np.nanstd(obs)
+    return _rmse(sim - obs, _and(mask, obs > threshold, sim.shape))
+
+
+def evaluate(sim, obs, warmup=0, weights=None, low_threshold=None,
+             peak_threshold=None, eps=None):
+    """
+    All the metrics in one pass over the data.
+    Returns a dict with NSE, RMSE, WRMSE, KGE, logNSE, RMSE_low and
+    RMSE_peak; values are floats, or arrays(N) for an ensemble.
+    """
+    sim, obs, mask = _prepare(sim, obs, warmup)
+    if low_threshold is None:
+        low_threshold = np.nanmean(obs)
+    if peak_threshold is None:
+        peak_threshold = np.nanmean(obs) + 2*np.nanstd(obs)
+    if eps is None:
+        eps = 0.01*np.nanmean(obs)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[warmup:]
+        if sim.ndim == 2:
+            weights = weights[:, None]
+
+    err = sim - obs
+    obs_b = obs*np.ones_like(sim)
+    ms = _mmean(sim, mask)
+    mo = _mmean(obs_b, mask)
+    ds = sim - ms
+    do = obs_b - mo
+    sse = _msum(err*err, mask)
+    sso = _msum(do*do, mask)
+    n = _count(sim, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ss = np.sqrt(_msum(ds*ds, mask)/n)
+        so = np.sqrt(sso/n)
+        r = _msum(ds*do, mask)/(n*ss*so)
+        lsim = np.log(sim + eps)
+        lobs = np.log(obs_b + eps)
+        result = {
+            'NSE': 1.0 - sse/sso,
+            'RMSE': np.sqrt(sse/n),
+            'WRMSE': _rmse(err, mask, weights),
+            'KGE': 1.0 - np.sqrt((r - 1)**2 + (ss/so - 1)**2 + (ms/mo - 1)**2),
+            'logNSE': _nse(lsim, lobs,
+                           _and(mask, np.isfinite(lsim) & np.isfinite(lobs),
+                                sim.shape)),
+            'RMSE_low': _rmse(err, _and(mask, obs < low_threshold, sim.shape)),
+            'RMSE_peak': _rmse(err, _and(mask, obs > peak_threshold,
+                                         sim.shape)),
+        }
+    if sim.ndim == 1:
+        result = dict((k, float(v)) for k, v in result.items())
+    return result
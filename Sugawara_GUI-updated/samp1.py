@@ -1,8 +1,16 @@
+import os
+from functools import partial
 import numpy as np
 import pandas as pd
 import scipy.optimize as opt
 import sugawara
-from sugawara import simulate, calibrate
+from sugawara import simulate
+from ascfile import read_asc, DT_HOURS
+import decimate
+import metrics
+from calibration import CalibrationJob
+import cache
+import instrument                                                               # Timers of the callbacks, off unless enabled
 from bokeh.io import curdoc
 from bokeh.layouts import widgetbox,gridplot, column, row
 from bokeh.models import ColumnDataSource
@@ -10,9 +18,12 @@ from bokeh.models.widgets import Slider, TextInput,  Panel, Tabs, Div, Button,Ra
 from bokeh.plotting import figure, show
 from bokeh.models.tools import HoverTool, WheelZoomTool
 from bokeh.models import Title,LinearAxis, Range1d
-from bokeh.models.widgets import DataTable, DateFormatter, TableColumn
+from bokeh.models.widgets import DataTable, DateFormatter, TableColumn, NumberFormatter
 
+CATCHMENT_AREA = 147.0                                                          # Catchment area [km2], not part of the .asc header
+sugawara.set_backend('auto')                                                    # Compiled simulate when numba is installed
     
+@instrument.timed('gui.loadParam')
 def loadParam():
     s_row = 0                                                                                   # Function to import pre-saved Parameters
     afp='para.txt'
@@ -26,10 +37,94 @@ def loadParam():
     w_rfcf.value = str(fp['rfcf'][0])
     w_ecorr.value = str(fp['ecorr'][0])
 
+def loadData(fname):
+    mtime = os.stat(fname).st_mtime_ns                                          # Parse (or memory-map) the file only when
+    if session['fname'] != fname or session['mtime'] != mtime:                  # it differs from the one cached for this session
+        with instrument.timer('gui.read_asc'):
+            asc = read_asc(fname)
+        session.update(fname=fname, mtime=mtime, asc=asc,
+                       x=asc.time_index(),
+                       prec=asc['Rainfall'] + asc['Snowfall'],
+                       evap=np.asarray(asc['ActualET']),
+                       q_sim=None, st_sim=None)
+    return session['asc']
+
+def setSeries(src, fig, y):
+    x = session['x']
+    if src in series and series[src][1] is not x:
+        sent.pop(src, None)                                                     # New time axis, x goes over again
+    x_ms = x.astype('datetime64[ms]').astype(np.int64)                           # Bokeh datetime ranges are in ms since epoch
+    series[src] = (fig, x, x_ms, np.asarray(y, dtype=float))                    # Keep the full series, send only what is visible
+    changed.add(src)                                                            # New y, sent even if the samples are the same
+    refreshSource(src)
+
+@instrument.timed('gui.refreshSource')
+def refreshSource(src):
+    fig, x, x_ms, y = series[src]
+    i0, i1 = decimate.window(x_ms, fig.x_range.start, fig.x_range.end,
+                             PLOT_MARGIN)
+    idx = decimate.minmax(y, int(PLOT_POINTS*(1 + 2*PLOT_MARGIN)), i0, i1)      # Min/max per bin keeps peaks visible
+    same = sent.get(src) is not None and np.array_equal(sent[src], idx)
+    if same and src not in changed:
+        return                                                                  # Same samples of the same y, nothing to send
+    with instrument.timer('gui.send', len(idx)):                               # Bokeh serializes the patch on assignment
+        if same:
+            src.data['y'] = y[idx]                                              # Same x samples, only send the new y column
+        else:
+            src.data = {'x': x[idx], 'y': y[idx]}
+    sent[src] = idx
+    changed.discard(src)
+
+@instrument.timed('gui.refreshFigure')
+def refreshFigure(fig):
+    pending.discard(fig)
+    for src in series:
+        if series[src][0] is fig:
+            refreshSource(src)
+
+def rangeChanged(fig):
+    if fig not in pending:                                                      # start and end change together, refresh once
+        pending.add(fig)
+        curdoc().add_next_tick_callback(lambda: refreshFigure(fig))
+
+def updateColumns(src, **columns):
+    n = len(next(iter(src.data.values()), []))
+    with instrument.timer('gui.send', n):
+        if all(len(col) == n for col in columns.values()):
+            src.data.update(**columns)                                          # Only the changed columns go over the websocket
+        else:
+            src.data = columns
+
+def showInput():
+    asc = session['asc']
+    setSeries(ds, prain, asc['Rainfall'])
+    setSeries(ds1, prain, asc['ActualET'])
+    setSeries(ds2, pdischarge, asc['Qrec'])
+    with instrument.timer('gui.send', len(asc)):
+        source2.data = {'x':np.asarray(asc['Time']), 'y':np.asarray(asc['Qrec']),  # Data Table from NumPy columns
+                        'y1':np.zeros(len(asc)), 'y2':np.asarray(asc['Rainfall']),
+                        'y3':np.asarray(asc['ActualET'])}
+
+def showSimulation(q_sim, st_sim):
+    session['q_sim'] = q_sim
+    session['st_sim'] = st_sim
+    setSeries(ds3, pdischarge, q_sim)                                           # Update glyphs with newly simulated data
+    setSeries(ds4, pstorage, st_sim[:, 0])
+    setSeries(ds5, pstorage, st_sim[:, 1])
+    updateColumns(source2, y1=q_sim)                                            # Only Qsim changes in the Data Table
+
+def showErrors(q_sim):
+    scores = metrics.evaluate(q_sim, session['asc']['Qrec'])                   # All metrics in one vectorised pass
+    NSE = round(scores['NSE'],3)
+    RMSE = round(scores['RMSE'],3)
+    source.data = dict(ErrorIndicator =['NSE', 'RMSE'], measurement=[str(NSE), str(RMSE)])
+
+@instrument.timed('gui.runModel')
 def runModel():                                                                                     # Function to run Sugawara Model
     s_row = 0                                                                                       # Function to import pre-saved Parameters
     afp='para.txt'
-    fp = pd.read_csv(afp, skiprows=s_row, skipinitialspace=True, index_col=False)
+    with instrument.timer('gui.read_params'):
+        fp = pd.read_csv(afp, skiprows=s_row, skipinitialspace=True, index_col=False)
     _k1 = fp['k1'][0]
     _k2 = fp['k2'][0]
     _k3 = fp['k3'][0]
@@ -39,159 +134,118 @@ def runModel():
     _rfcf = fp['rfcf'][0]
     _ecorr = fp['ecorr'][0]
    
-    extra_pars = [1, 147.0]       
+    extra_pars = [DT_HOURS, CATCHMENT_AREA]
     pars = [_k1,_k2,_k3,_k4,_d1,_d2,_rfcf,_ecorr]                                                        # Parameters to be used during simulation
 
-    new_f= str(w_fn.value)
-    skip_rows = 16  
-    data = pd.read_csv(new_f,                                      
-                       skiprows=skip_rows,
-                       skipinitialspace=True)
-    time_index = pd.date_range('1994 12 07 20:00', periods=len(data), freq='H')
-    data.insert(loc=0, column='DateTime', value = time_index)                   # To use precipitation data and ET data
-    prec = np.array(data['Rainfall']) + np.array(data['Snowfall'])              # loaded earlier for simulation
-    evap = np.array(data['ActualET'])
+    loadData(str(w_fn.value))                                                   # Cached for the session
+    prec = session['prec']                                                      # To use precipitation data and ET data
+    evap = session['evap']                                                      # loaded earlier for simulation
     q_sim, st_sim = sugawara.simulate(prec=prec[:-1],                           # Run Sugawara Model
                                   evap=evap[:-1], 
                                   param=pars, 
                                   extra_param=extra_pars)  # Run the model
-    Format_q_sim = [ '%.3f' % elem for elem in q_sim]                           # Rounding off simulated discharge into 3 decimal pt
-    S1 = [None]*len(q_sim)
-    S2 = [None]*len(q_sim)         
-    
-    for t in range(len(q_sim)):
-        S1[t] = float(st_sim[t][0])                                             # Store States into two lists respectively
-        S2[t] = float(st_sim[t][1])
-    
-    # Update Glyphs
-    ds3.data = {'x':data['DateTime'],'y':q_sim}                                # Update glyphs with newly simulated data
-    ds4.data = {'x':data['DateTime'],'y':S1}
-    ds5.data = {'x':data['DateTime'], 'y':S2}
-    
-    # Update Data Table
-    time = data['Time'].tolist()                                         # Convert all from Pandas DF into lists, for consistency
-    Qrec = data['Qrec'].tolist()
-    Rain = data['Rainfall'].tolist()
-    ET = data['ActualET'].tolist()
-    source2.data = {'x':time, 'y':Qrec, 'y1':Format_q_sim, 'y2':Rain, 'y3':ET}         # Update Data Table
+    showSimulation(q_sim, st_sim)
      
-    # Update Error Table for NSE and RMSE
-    NSE_total = sugawara.NSE(q_sim,data['Qrec'], q='def', j=2.0)                  # Calcalate and update Error Data Table
-    NSE = round(NSE_total,3)
-    
-    RMSE_list = []
-    for j in range(len(q_sim)):
-        val = round((q_sim[j] - data.iloc[j,3])**2.0,3)
-        RMSE_list.append(val)
-    RMSE = round((sum(RMSE_list)/len(q_sim))**0.5,3)    
-    source.data = dict(ErrorIndicator =['NSE', 'RMSE'], measurement=[str(NSE), str(RMSE)])
+    showErrors(q_sim)                                                          # Update Error Table for NSE and RMSE
 
 
+@instrument.timed('gui.loadInputFile')
 def loadInputFile(): 
-    new_f = str(w_fn.value)                                              # Load Input File using Text Input File Name
-    skip_rows = 16  
-
-    data = pd.read_csv(new_f,                                            # Use Pandas DF to read file                                 
-                       skiprows=skip_rows,
-                       skipinitialspace=True)
-    
-    time_index = pd.date_range('1994 12 07 20:00', periods=len(data), freq='H') # Create time indices
-    
-    data.insert(loc=0, column='DateTime', value = time_index)   
-    
-    # Update Glyphs
-    ds.data = {'x':data['DateTime'], 'y':data['Rainfall']}                       # Update glpyhs
-    ds1.data = {'x':data['DateTime'], 'y':data['ActualET']}
-    ds2.data = {'x':data['DateTime'], 'y':data['Qrec']}
-    
-    # Update Data Table               
-    time = data['Time'].tolist()                                         # Update Data Table 
-    Qrec = data['Qrec'].tolist()                                         # First convert all into lists for consistency
-    Rain = data['Rainfall'].tolist()
-    ET = data['ActualET'].tolist()
-    source2.data = {'x':time, 'y':Qrec,'y1':q_sim, 'y2':Rain, 'y3':ET}               # Update Data Table
+    loadData(str(w_fn.value))                                            # Load Input File using Text Input File Name
+    showInput()                                                          # Update glyphs and Data Table
+    n = len(session['asc'])
+    showSimulation(np.zeros(n), np.zeros((n, 2)))                        # Clear the previous simulation
     
 
+@instrument.timed('gui.calibrateModel')
 def calibrateModel():
-    new_f = str(w_fn.value)                                              # Calibrate Model
-    skip_rows = 16  
-    data = pd.read_csv(new_f,
-                       skiprows=skip_rows,
-                       skipinitialspace=True)
-    time_index = pd.date_range('1994 12 07 20:00', periods=len(data), freq='H')
-    data.insert(loc=0, column='DateTime', value = time_index)  
-    prec = np.array(data['Rainfall']) + np.array(data['Snowfall'])
-    evap = np.array(data['ActualET'])
-    extra_pars = [1, 147.0]
-    pars, NSE = calibrate(prec, evap, extra_pars, data['Qrec'], verbose=False)  # Calibrate Model by passing into function
+    if job['current'] is not None and job['current'].running():         # One calibration per session at a time
+        return
+    asc = loadData(str(w_fn.value))                                      # Calibrate Model
+    prec = session['prec']
+    evap = session['evap']
+    extra_pars = [DT_HOURS, CATCHMENT_AREA]
+    w_calibrate.disabled = True
+    w_cancel.disabled = False
+    job['current'] = CalibrationJob(prec, evap, extra_pars, asc['Qrec'],  # Runs off the Bokeh event loop, the objective
+                                    progress=calibrationProgress,        # is evaluated in a worker process
+                                    done=calibrationDone,
+                                    min_interval=PROGRESS_INTERVAL).start()
+
+@instrument.timed('gui.cancelCalibration')
+def cancelCalibration():
+    if job['current'] is not None:
+        job['current'].cancel()                                          # Stops at the next objective evaluation
+
+def calibrationProgress(iteration, nse, pars, q_sim):                    # Called from the calibration thread
+    doc.add_next_tick_callback(partial(showProgress, iteration, nse, pars, q_sim))
+
+def calibrationDone(cal_job):                                            # Called from the calibration thread
+    doc.add_next_tick_callback(partial(finishCalibration, cal_job))
+
+def showParameters(pars):
+    index_para = ['k1','k2','k3','k4','d1','d2','rfcf','ecorr']                 
+    Formattedpars = [ '%.3f' % elem for elem in pars]                          # Update Parameter Table
+    source3.data = {'x':index_para, 'y':Formattedpars}
+    return Formattedpars
+
+@instrument.timed('gui.showProgress')
+def showProgress(iteration, nse, pars, q_sim):
+    showParameters(pars)                                                       # Current best parameters and flow
+    setSeries(ds3, pdischarge, q_sim)
+    source.data = dict(ErrorIndicator =['NSE', 'Iteration'], measurement=[str(round(nse,3)), str(iteration)])
+
+@instrument.timed('gui.finishCalibration')
+def finishCalibration(cal_job):
+    w_calibrate.disabled = False
+    w_cancel.disabled = True
+    if cal_job.result is None:                                                 # Cancelled or failed, keep the last progress shown
+        return
+    pars = cal_job.result.x
+    prec = session['prec']
+    evap = session['evap']
+    extra_pars = [DT_HOURS, CATCHMENT_AREA]
     
     q_sim, st_sim = simulate(prec=prec[:-1],                           # based on calibrated parameters, re-run results
                                   evap=evap[:-1], 
                                   param=pars, 
                                   extra_param=extra_pars)
-    Format_q_sim = [ '%.3f' % elem for elem in q_sim]                           # Obtain calibrated q_sim and states
-    S1 = [None]*len(q_sim)                                                      # Convert into 3 decimal places
-    S2 = [None]*len(q_sim)
-    
-    for t in range(len(q_sim)):                  
-        S1[t] = float(st_sim[t][0])
-        S2[t] = float(st_sim[t][1])
-    
-    # Update Glyphs                                                             # Update Glyphs
-    ds3.data = {'x':data['DateTime'], 'y':q_sim}
-    ds4.data = {'x':data['DateTime'], 'y':S1}
-    ds5.data = {'x':data['DateTime'], 'y':S2}
-    
-    # Update Data Table                                                         # Update Data Table
-    time = data['Time'].tolist()
-    Qrec = data['Qrec'].tolist()
-    Rain = data['Rainfall'].tolist()
-    ET = data['ActualET'].tolist()
-    source2.data = {'x ':time,'y':Qrec, 'y1':Format_q_sim, 'y2':Rain, 'y3':ET}
+    showSimulation(q_sim, st_sim)                                               # Update Glyphs and Data Table
     
     # Update Parameters Table
-    index_para = ['k1','k2','k3','k4','d1','d2','rfcf','ecorr']                 
-    Formattedpars = [ '%.3f' % elem for elem in pars]                          # Update Parameter Table
-    source3.data = {'x':index_para, 'y':Formattedpars}
+    Formattedpars = showParameters(pars)
     
     for elem in Formattedpars:
         para_formatted.append(elem)                                            # Update parameter list outside function 
     
-    # Update Error Table
-    NSE_total = sugawara.NSE(q_sim,data['Qrec'], q='def',j=2.0)                 # Update Error Table
-    NSE = round(NSE_total,3)
-    RMSE_list = []
-    for j in range(len(q_sim)):
-        val = round((q_sim[j] - data.iloc[j,3])**2.0,3)
-        RMSE_list.append(val)
-    RMSE = round((sum(RMSE_list)/len(q_sim))**0.5,3)
-    source.data = dict(ErrorIndicator =['NSE', 'RMSE'], measurement=[str(NSE), str(RMSE)])
+    showErrors(q_sim)                                                          # Update Error Table for NSE and RMSE
  
-    
+
+#                               Session Cache                                #
+session = dict(fname=None, mtime=None)                                          # Bokeh runs this script once per session, so
+series = {}                                                                     # these module globals belong to one session
+sent = {}                                                                       # Indices last sent for each plot source
+pending = set()                                                                 # Figures waiting for a range refresh
+PLOT_POINTS = 1600                                                              # Points sent per line, about two per pixel
+PLOT_MARGIN = 0.5                                                               # Off-screen width sent on each side, in widths
+changed = set()                                                                 # Plot sources whose y changed since last sent
+job = dict(current=None)                                                        # Background calibration of this session
+PROGRESS_INTERVAL = 1.0                                                         # Seconds between calibration progress updates
+doc = curdoc()                                                                  # Captured for callbacks from worker threads
+cache.configure(directory='__simcache__')                                       # Calibrated parameters persist across sessions
+
 #                               Load Empty ASC File                          #
-skip_rows = 16  # Number of rows to skip in the output file
 output_file = 'empty.asc'                                                       # Pass an empty file to reflect empty glpyhs
-    
-# Read data from the output file
-data = pd.read_csv(output_file,                                                 # Read empty file 
-                   skiprows=skip_rows,
-                   skipinitialspace=True)
-time_index = pd.date_range('1994 12 07 20:00', periods=len(data), freq='H')
-data.insert(loc=0, column='DateTime', value = time_index)  
-
-#                                     Empty Lists                   ##
-
-q_sim = [0.0]*len(data['DateTime'])                                             # Create empty lists so glyphs are emtpy                            
-S1 = [0.0]*len(data['DateTime'])
-S2 = [0.0]*len(data['DateTime'])
+loadData(output_file)                                                           # Read empty file 
+
 NSE = "N.A."                                                                    # Errors are empty at the beginning
 RMSE =  "N.A."   
-ds = ColumnDataSource({'x':data['DateTime'], 'y':data['Rainfall']})              # Map data to ColumnDataSource for plotting
-ds1 = ColumnDataSource({'x':data['DateTime'], 'y':data['ActualET']}) 
-ds2 = ColumnDataSource({'x':data['DateTime'],'y':data['Qrec']}) 
-ds3= ColumnDataSource({'x':data['DateTime'], 'y':q_sim}) 
-ds4= ColumnDataSource({'x':data['DateTime'],'y':S1})   
-ds5= ColumnDataSource({'x':data['DateTime'], 'y':S2})   
+ds = ColumnDataSource({'x':[], 'y':[]})                                          # Filled once the figures exist, see showInput
+ds1 = ColumnDataSource({'x':[], 'y':[]}) 
+ds2 = ColumnDataSource({'x':[], 'y':[]}) 
+ds3= ColumnDataSource({'x':[], 'y':[]}) 
+ds4= ColumnDataSource({'x':[], 'y':[]})   
+ds5= ColumnDataSource({'x':[], 'y':[]})   
 
                             
 #  Plotting and Assigning to Glyph / Hover Tools   
@@ -340,11 +394,11 @@ w_loadpara.on_click(loadParam)
 
 
 # DataTable 1 for Q
-datatable1 = {'x':data['Time'],'y':data['Qrec'], 'y1':q_sim, 'y2':data['Rainfall'], 'y3':data['ActualET']}  
+datatable1 = {'x':[], 'y':[], 'y1':[], 'y2':[], 'y3':[]}                                 # Filled by showInput
 source2 = ColumnDataSource(datatable1)                                                        # Setting up Data Table ; Mapping using ColumnDataSource
 columns = [TableColumn(field= 'x', title= 'Time (h)'),
         TableColumn(field= 'y', title="Qrec (m3/h)"),
-        TableColumn(field= 'y1', title="Qsim (m3/h)"),
+        TableColumn(field= 'y1', title="Qsim (m3/h)", formatter=NumberFormatter(format='0.000')),
         TableColumn(field= 'y2', title="Rainfall (mm)"),
         TableColumn(field= 'y3', title="Evapotranspiration (mm)")]
                                                                                                   # Create Heading for Data Table
@@ -378,6 +432,9 @@ w_runmodel.on_click(runModel)
 # Calibrate Model
 w_calibrate = Button(label='Calibrate', button_type="warning")                  # Set up Calibration Button
 w_calibrate.on_click(calibrateModel)
+w_cancel = Button(label='Cancel Calibration', button_type="danger",            # Cancel a running calibration
+                  disabled=True)
+w_cancel.on_click(cancelCalibration)
 C_title = Div(text="<font color ='#808080'><h4> Calibration </h4></font>",\
               width = 400, height = 2)                                          # Create heading for Calibration
 spacing1 = Div(text="<font color ='#808080'><h1> </h1></font>",\
@@ -412,12 +469,19 @@ data_table2 = DataTable(source=source3, columns=columns, width=300, height=120)
 #export_table= Button(label='Export Table', button_type="default")                # Create export table button
 #export_table.on_click(exportParam)                                               # Export Function
 
+#                              Plot Updates                                 #
+for fig in (prain, pdischarge, pstorage):                                       # Re-decimate when the visible x-range changes
+    fig.x_range.on_change('start', lambda attr, old, new, fig=fig: rangeChanged(fig))
+    fig.x_range.on_change('end', lambda attr, old, new, fig=fig: rangeChanged(fig))
+showInput()                                                                     # Initial (empty) glyphs and Data Table
+showSimulation(np.zeros(len(session['asc'])), np.zeros((len(session['asc']), 2)))   # Empty simulation glyphs
+
 #                                  Layout       
 widgetrow1 = widgetbox(spacing4, w_loadinput)
 widgetcol2 = widgetbox(w_k1,w_k2,w_k3,w_k4,w_loadpara)
 widgetcol3 = widgetbox(w_d1,w_d2,w_rfcf,w_ecorr)#,w_savepara)
 widget7 = widgetbox(heading_dis,data_table1,w_fn,spacing6,heading2)
-widget5 = widgetbox(C_title,spacing2,spacing1,w_calibrate,heading_para,data_table2)#,export_table)
+widget5 = widgetbox(C_title,spacing2,spacing1,w_calibrate,w_cancel,heading_para,data_table2)#,export_table)
 widget6 = widgetbox(RM_title,spacing3,spacing5, w_runmodel,heading_error, data_table)
 r=row(heading)
 g = gridplot([[widget7,widgetrow1,prain],[widgetcol2,widgetcol3,pdischarge],[widget6,widget5,pstorage]])
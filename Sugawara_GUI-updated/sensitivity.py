@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Global sensitivity analysis of the eight Sugawara parameters
+
+morris -> elementary effects on Morris trajectories (mu, mu*, sigma)
+sobol -> first and total order indices on a Saltelli design
+         (Saltelli et al. 2010 and Jansen estimators)
+
+Both designs are built in the unit cube and scaled to PARAM_BND. The model
+is run in chunks through sugawara.simulate_batch on a process pool, and
+each chunk is scored with a metric from the metrics module (any function
+metric(sim, obs, warmup) that accepts an ensemble). Confidence intervals
+come from a bootstrap over trajectories or over the rows of the design.
+"""
+from __future__ import division
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import sugawara
+import metrics
+import worker
+from sugawara import LOWER, UPPER
+from worker import default_workers
+
+PARAM_NAMES = ('k1', 'k2', 'k3', 'k4', 'd1', 'd2', 'rfcf', 'ecorr')
+
+def _score_chunk(params):
+    data = worker.STATE['sensitivity']
+    q_sim = sugawara.simulate_batch(data['prec'], data['evap'], params,
+                                    data['extra_param'],
+                                    return_states=False)[0]
+    return data['metric'](q_sim, data['q_obs'], data['warmup'])
+
+
+def _evaluate(unit, prec, evap, extra_param, q_obs, metric, warmup,
+              chunk_size, workers):
+    """Metric of every row of the unit-cube design unit(n, 8)."""
+    params = LOWER + unit*(UPPER - LOWER)
+    data = {'prec': np.asarray(prec, dtype=float)[:-1],
+            'evap': np.asarray(evap, dtype=float)[:-1],
+            'extra_param': list(extra_param),
+            'q_obs': np.asarray(q_obs, dtype=float), 'warmup': warmup,
+            'metric': metric}
+    chunks = [params[i:i + chunk_size]
+              for i in range(0, len(params), chunk_size)]
+    workers = workers or default_workers()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=worker.install,
+                                 initargs=('sensitivity', data)) as pool:
+            scores = list(pool.map(_score_chunk, chunks))
+    else:
+        worker.install('sensitivity', data)
+        scores = [_score_chunk(c) for c in chunks]
+    return np.concatenate(scores)
+
+
+def _interval(samples, ci):
+    tail = 50.0*(1.0 - ci)
+    return np.nanpercentile(samples, [tail, 100.0 - tail], axis=0).T
+
+
+def morris_design(n_trajectories, levels=4, seed=0):
+    """
+    Morris trajectories in the unit cube.
+    Returns the points(r*(d+1), d), the factor moved at every step(r, d)
+    and the signed step of that move(r, d).
+    """
+    rng = np.random.default_rng(seed)
+    d = len(LOWER)
+    delta = levels/(2.0*(levels - 1))
+    base = rng.integers(0, levels//2, size=(n_trajectories, d))/(levels - 1.0)
+    sign = rng.choice([-1.0, 1.0], size=(n_trajectories, d))
+    order = np.argsort(rng.random((n_trajectories, d)), axis=1)
+    start = base + delta*(sign < 0)
+
+    rows = np.arange(n_trajectories)[:, None]
+    step = np.zeros((n_trajectories, d, d))
+    step[rows, np.arange(d)[None, :], order] = (sign*delta)[rows, order]
+    points = np.concatenate((start[:, None, :],
+                             start[:, None, :] + np.cumsum(step, axis=1)),
+                            axis=1)
+    return points.reshape(-1, d), order, (sign*delta)[rows, order]
+
+
+def morris(prec, evap, extra_param, q_obs, n_trajectories=50, levels=4,
+           metric=metrics.nse, warmup=0, seed=0, n_boot=1000, ci=0.95,
+           chunk_size=500, workers=None):
+    """
+    Morris elementary effects screening, r*(d+1) model runs.
+
+    prec, evap, extra_param, q_obs -> as in sugawara.calibrate
+    n_trajectories -> number of trajectories r
+    levels -> number of grid levels p
+    metric -> metric(sim, obs, warmup) of the metrics module
+    n_boot, ci -> bootstrap replicates and level of the intervals
+
+    Returns a dict with the parameter names, mu, mu_star, sigma and
+    mu_star_ci(d, 2), the number of runs and the wall-clock time. Effects
+    are per unit of the scaled range, so they compare across parameters.
+    """
+    start = time.perf_counter()
+    unit, order, step = morris_design(n_trajectories, levels, seed)
+    d = len(LOWER)
+    y = _evaluate(unit, prec, evap, extra_param, q_obs, metric, warmup,
+                  chunk_size, workers).reshape(n_trajectories, d + 1)
+
+    effects = np.empty((n_trajectories, d))
+    rows = np.arange(n_trajectories)[:, None]
+    effects[rows, order] = np.diff(y, axis=1)/step
+
+    rng = np.random.default_rng(seed)
+    boot = rng.integers(0, n_trajectories, size=(n_boot, n_trajectories))
+    mu_star_boot = np.abs(effects)[boot].mean(axis=1)
+    return {'names': PARAM_NAMES,
+            'mu': effects.mean(axis=0),
+            'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1),
+            'mu_star_ci': _interval(mu_star_boot, ci),
+            'n_runs': len(unit),
+            'wall_time': time.perf_counter() - start}
+
+
+def saltelli_design(n, sampling='sobol', seed=0):
+    """
+    Unit-cube matrices A(n, d), B(n, d) and AB(d, n, d), where AB[i] is A
+    with column i taken from B.
+    sampling -> 'sobol' (scrambled Sobol sequence) or 'random'
+    """
+    d = len(LOWER)
+    rng = np.random.default_rng(seed)
+    if sampling == 'sobol':
+        from scipy.stats import qmc
+        u = qmc.Sobol(2*d, scramble=True, seed=rng).random(n)
+    elif sampling == 'random':
+        u = rng.random((n, 2*d))
+    else:
+        raise ValueError("sampling must be 'sobol' or 'random', got %r"
+                         % sampling)
+    a, b = u[:, :d], u[:, d:]
+    ab = np.repeat(a[None, :, :], d, axis=0)
+    for i in range(d):
+        ab[i, :, i] = b[:, i]
+    return a, b, ab
+
+
+def _sobol_indices(fa, fb, fab):
+    var = np.var(np.concatenate((fa, fb), axis=-1), axis=-1)
+    first = np.mean(fb[..., None, :]*(fab - fa[..., None, :]), axis=-1)
+    total = 0.5*np.mean((fa[..., None, :] - fab)**2, axis=-1)
+    return first/var[..., None], total/var[..., None]
+
+
+def sobol(prec, evap, extra_param, q_obs, n=1024, metric=metrics.nse,
+          warmup=0, sampling='sobol', seed=0, n_boot=1000, ci=0.95,
+          chunk_size=500, workers=None):
+    """
+    Sobol first and total order indices, n*(d+2) model runs.
+
+    prec, evap, extra_param, q_obs -> as in sugawara.calibrate
+    n -> rows of the base matrices (a power of 2 for Sobol sampling)
+    metric -> metric(sim, obs, warmup) of the metrics module
+    n_boot, ci -> bootstrap replicates and level of the intervals
+
+    Returns a dict with the parameter names, S1, S1_ci(d, 2), ST,
+    ST_ci(d, 2), the number of runs and the wall-clock time.
+    """
+    start = time.perf_counter()
+    a, b, ab = saltelli_design(n, sampling, seed)
+    d = len(LOWER)
+    y = _evaluate(np.concatenate((a, b, ab.reshape(-1, d))), prec, evap,
+                  extra_param, q_obs, metric, warmup, chunk_size, workers)
+    fa, fb, fab = y[:n], y[n:2*n], y[2*n:].reshape(d, n)
+    first, total = _sobol_indices(fa, fb, fab)
+
+    rng = np.random.default_rng(seed)
+    first_boot = np.empty((n_boot, d))
+    total_boot = np.empty((n_boot, d))
+    # Blocks of replicates keep the (block, d, n) temporaries small
+    block = max(1, 2**22//(d*n))
+    for i in range(0, n_boot, block):
+        idx = rng.integers(0, n, size=(min(block, n_boot - i), n))
+        first_boot[i:i + block], total_boot[i:i + block] = _sobol_indices(
+            fa[idx], fb[idx], fab[:, idx].transpose(1, 0, 2))
+    return {'names': PARAM_NAMES,
+            'S1': first, 'S1_ci': _interval(first_boot, ci),
+            'ST': total, 'ST_ci': _interval(total_boot, ci),
+            'n_runs': len(y),
+            'wall_time': time.perf_counter() - start}
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP simulation service
+
+Keeps forcing datasets in memory and answers JSON requests over HTTP/1.1
+(standard library only):
+
+    GET  /datasets              names, lengths and extra_param
+    POST /simulate              {"dataset": name, "param": [8 values]}
+                                -> {"q": flow(T)}
+    POST /score                 {"dataset": name, "param": [...],
+                                 "warmup": 0} -> metrics.evaluate values,
+                                null where undefined
+    GET  /stats                 latency p50/p99, throughput, batch sizes
+
+Requests for the same dataset (and warmup) arriving within `window`
+seconds are coalesced into one batched evaluation, which runs on a
+process pool so the event loop only parses and answers requests. While
+every worker is busy, open batches keep collecting requests, so batches
+grow with the load instead of queueing up.
+
+    python service.py manifest.csv --port 8765
+    python service.py output.asc --area 147 --dt 1
+"""
+from __future__ import division, print_function
+import argparse
+import asyncio
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+import sugawara
+import metrics
+import worker
+from ascfile import read_asc
+from calibration import BATCH_MIN
+
+WINDOW = 0.005
+MAX_BATCH = 256
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def load_dataset(fname, area, dt):
+    """Forcing and record of an .asc file, as the service keeps it."""
+    asc = read_asc(fname)
+    prec = asc['Rainfall'] + asc['Snowfall']
+    return {'prec': np.ascontiguousarray(prec[:-1]),
+            'evap': np.ascontiguousarray(asc['ActualET'][:-1]),
+            'q_rec': np.array(asc['Qrec']),
+            'extra_param': [dt, area]}
+
+
+def _run_batch(name, params, warmup, flow_cols):
+    data = worker.STATE['service'][name]
+    if len(params) < BATCH_MIN or sugawara.get_backend() != 'python':
+        q = np.column_stack([
+            sugawara.simulate(data['prec'], data['evap'], param,
+                              data['extra_param'], return_states=False)[0]
+            for param in params])
+    else:
+        q = sugawara.simulate_batch(data['prec'], data['evap'], params,
+                                    data['extra_param'],
+                                    return_states=False)[0]
+    scores = metrics.evaluate(q, data['q_rec'], warmup=warmup)
+    return q[:, flow_cols], scores
+
+
+class SimulationService(object):
+    """
+    datasets -> {name: load_dataset(...)}
+    window -> seconds a batch stays open for more requests
+    max_batch -> parameter sets that close a batch early
+    workers -> processes evaluating batches, one per core by default
+    backend -> sugawara.simulate backend of the workers
+    """
+
+    def __init__(self, datasets, window=WINDOW, max_batch=MAX_BATCH,
+                 workers=None, backend='auto'):
+        self.datasets = datasets
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=worker.install,
+            initargs=('service', datasets, backend))
+        self.latencies = collections.deque(maxlen=100000)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_batched = 0
+        self.started = time.perf_counter()
+        self._pending = {}
+        self._in_flight = 0
+        self._server = None
+
+    # Batching
+
+    async def evaluate(self, name, param, warmup=0, flow=False):
+        """Metrics, and the flow if asked, of one parameter set."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        k = (name, warmup)
+        if k not in self._pending:
+            timer = loop.call_later(self.window, self._due, k)
+            self._pending[k] = [[], timer]
+        items = self._pending[k][0]
+        items.append((param, flow, future))
+        if len(items) >= self.max_batch:
+            self._flush(k)
+        return await future
+
+    def _due(self, k):
+        # Window over: send the batch now if a worker is free, otherwise it
+        # keeps growing until one is (see _resolve)
+        if k in self._pending:
+            self._pending[k][1] = None
+            if self._in_flight < self.workers:
+                self._flush(k)
+
+    def _flush(self, k):
+        items, timer = self._pending.pop(k)
+        if timer is not None:
+            timer.cancel()
+        name, warmup = k
+        params = np.array([item[0] for item in items])
+        flow_cols = [i for i, item in enumerate(items) if item[1]]
+        self.n_batches += 1
+        self.n_batched += len(items)
+        self._in_flight += 1
+        task = asyncio.get_running_loop().run_in_executor(
+            self.executor, _run_batch, name, params, warmup, flow_cols)
+        task.add_done_callback(lambda t: self._resolve(items, flow_cols, t))
+
+    def _resolve(self, items, flow_cols, task):
+        self._in_flight -= 1
+        due = [k for k, (_, timer) in self._pending.items() if timer is None]
+        if due:
+            self._flush(due[0])
+
+        if task.cancelled() or task.exception() is not None:
+            error = task.exception() if not task.cancelled() \
+                else asyncio.CancelledError()
+            for item in items:
+                if not item[2].done():
+                    item[2].set_exception(error)
+            return
+        q, scores = task.result()
+        column = dict((i, j) for j, i in enumerate(flow_cols))
+        for i, (_, flow, future) in enumerate(items):
+            # JSON has no NaN: undefined metrics (e.g. a flow of NaN) are null
+            result = {'metrics': dict((key, float(value[i])
+                                       if np.isfinite(value[i]) else None)
+                                      for key, value in scores.items())}
+            if flow:
+                result['q'] = q[:, column[i]].tolist()
+            if not future.done():
+                future.set_result(result)
+
+    # HTTP
+
+    async def _route(self, method, path, body):
+        if path == '/datasets' and method == 'GET':
+            return 200, dict((name, {'n_steps': len(d['q_rec']),
+                                     'extra_param': d['extra_param']})
+                             for name, d in self.datasets.items())
+        if path == '/stats' and method == 'GET':
+            return 200, self.stats()
+        if path not in ('/simulate', '/score'):
+            return 404, {'error': 'unknown path %s' % path}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+
+        try:
+            request = json.loads(body or b'{}')
+            name = request['dataset']
+            param = np.asarray(request['param'], dtype=float)
+            warmup = int(request.get('warmup', 0))
+        except (ValueError, KeyError, TypeError) as err:
+            return 400, {'error': 'bad request: %s' % err}
+        if name not in self.datasets:
+            return 400, {'error': 'unknown dataset %r' % name}
+        if param.shape != (8,):
+            return 400, {'error': 'param needs the 8 model parameters'}
+        n_steps = len(self.datasets[name]['q_rec'])
+        if not 0 <= warmup < n_steps:
+            return 400, {'error': 'warmup must be in [0, %d), not %d'
+                                  % (n_steps, warmup)}
+
+        result = await self.evaluate(name, param, warmup,
+                                     flow=path == '/simulate')
+        if path == '/simulate':
+            return 200, {'q': result['q']}
+        return 200, result['metrics']
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                start = time.perf_counter()
+                method, path = line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if not header.strip():
+                        break
+                    key, _, value = header.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+                try:
+                    status, payload = await self._route(method, path, body)
+                except Exception as err:
+                    status, payload = 500, {'error': repr(err)}
+                data = json.dumps(payload).encode()
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: %d\r\n\r\n'
+                              % (status, _REASONS[status], len(data))).encode()
+                             + data)
+                await writer.drain()
+                if path in ('/simulate', '/score'):
+                    self.n_requests += 1
+                    self.latencies.append(time.perf_counter() - start)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def stats(self):
+        """Latency percentiles (s), throughput (requests/s), batch sizes."""
+        lat = np.asarray(self.latencies)
+        elapsed = time.perf_counter() - self.started
+        return {'requests': self.n_requests,
+                'p50': float(np.percentile(lat, 50)) if len(lat) else None,
+                'p99': float(np.percentile(lat, 99)) if len(lat) else None,
+                'throughput': self.n_requests/elapsed,
+                'batches': self.n_batches,
+                'mean_batch': (self.n_batched/self.n_batches
+                               if self.n_batches else None)}
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """Starts listening; returns the port (useful with port=0)."""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.started = time.perf_counter()
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, host='127.0.0.1', port=8765):
+        await self.start(host, port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self.executor.shutdown(wait=False)
+
+
+def run_in_thread(service, host='127.0.0.1', port=0):
+    """
+    Runs the service on an event loop in a daemon thread, e.g. for tests
+    and benchmarks. Returns the port it listens on.
+    """
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        state['port'] = loop.run_until_complete(service.start(host, port))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return state['port']
+
+
+def request(url, payload=None, timeout=30.0):
+    """JSON request to the service; POST when a payload is given."""
+    data = None if payload is None else json.dumps(payload).encode()
+    req = Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('data', nargs='+',
+                        help='.asc files or batch_runner manifest CSVs')
+    parser.add_argument('--area', type=float, default=147.0,
+                        help='catchment area [km2] of bare .asc files')
+    parser.add_argument('--dt', type=float, default=1.0,
+                        help='time step [h] of bare .asc files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window', type=float, default=WINDOW)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default='auto')
+    args = parser.parse_args(argv)
+
+    from batch_runner import read_manifest
+    datasets = {}
+    for fname in args.data:
+        if fname.lower().endswith('.csv'):
+            for job in read_manifest(fname):
+                datasets[job['name']] = load_dataset(job['file'], job['area'],
+                                                     job['dt'])
+        else:
+            name = os.path.splitext(os.path.basename(fname))[0]
+            datasets[name] = load_dataset(fname, args.area, args.dt)
+
+    service = SimulationService(datasets, args.window, args.max_batch,
+                                args.workers, args.backend)
+    print('serving %s on http://%s:%d' % (', '.join(sorted(datasets)),
+                                          args.host, args.port))
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,17 @@ Tank Model
 Implemented By Juan Chacon
 """
 from __future__ import division
+import os
+import warnings
+
 import numpy as np
-import scipy.io as io
-import matplotlib.pyplot as plt
-import scipy.optimize as opt
+
+import instrument
 #%%
+# Version of the model equations, part of the keys of memoized objective
+# values and calibration results; bump it whenever _step changes results
+MODEL_VERSION = 1
+
 INITIAL_STATES = [10, 10]
 INITIAL_Q = 1.0
 INITIAL_PARAM = [0.5, 0.2, 0.01, 0.1, 10.0, 20.0, 1, 1]
@@ -27,6 +33,9 @@ PARAM_BND = ((0.0, 1.1),
              (0.1, 1.0),
              (0.8, 1.2),
 			 (0.8, 1.2))
+# The same bounds as arrays(8)
+LOWER = np.array([b[0] for b in PARAM_BND], dtype=float)
+UPPER = np.array([b[1] for b in PARAM_BND], dtype=float)
 
 
 def _step(prec, evap, st, param, extra_param):
@@ -132,34 +141,416 @@ def _step(prec, evap, st, param, extra_param):
 #        print('s1 below zero')
     return Q, S
 
-def simulate(prec, evap, param, extra_param):
+# Simulation backends, name -> module providing simulate() with the same
+# interface. 'python' is the reference implementation below; the others
+# are imported on first use.
+BACKENDS = {'python': None, 'numba': 'numba_backend'}
+_backend = {'name': 'python', 'loaded': {'python': None}, 'missing': set()}
+
+def _load_backend(name):
+    if name == 'auto':
+        name = 'numba' if 'numba' in available_backends() else 'python'
+    if name not in BACKENDS:
+        raise ValueError('unknown backend %r, expected one of %s'
+                         % (name, ', '.join(sorted(BACKENDS))))
+    if name not in _backend['loaded']:
+        _backend['loaded'][name] = __import__(BACKENDS[name]).simulate
+    return name, _backend['loaded'][name]
+
+def available_backends():
+    '''Names of the backends that can be loaded here.'''
+    names = []
+    for name in sorted(BACKENDS):
+        if name in _backend['missing']:
+            continue
+        try:
+            _load_backend(name)
+        except ImportError:
+            _backend['missing'].add(name)
+            continue
+        names.append(name)
+    return names
+
+def set_backend(name):
+    '''
+    Selects the backend used by simulate ('python', 'numba', ...).
+    'auto' picks numba when it is installed and python otherwise. The
+    default comes from the SUGAWARA_BACKEND environment variable.
+    Returns the name of the backend selected.
+    '''
+    name = _load_backend(name)[0]
+    _backend['name'] = name
+    return name
+
+def get_backend():
+    '''Name of the backend used by simulate.'''
+    return _backend['name']
+
+def _backend_from_environment():
+    # Resolved once at import; a name that cannot be loaded here falls
+    # back to the Python reference instead of failing every simulate
+    name = os.environ.get('SUGAWARA_BACKEND') or 'python'
+    if name == 'python':
+        return name
+    available = available_backends()
+    if name == 'auto':
+        return 'numba' if 'numba' in available else 'python'
+    if name not in available:
+        warnings.warn('SUGAWARA_BACKEND=%r is not available here (one of '
+                      '%s or auto), using python'
+                      % (name, ', '.join(available)), RuntimeWarning)
+        return 'python'
+    return name
+
+_backend['name'] = _backend_from_environment()
+
+def _n_steps(prec, *args, **kwargs):
+    # Items of the instrument timers: time steps run
+    return len(prec)
+
+def _n_member_steps(prec, evap, params, *args, **kwargs):
+    return len(prec)*len(params)
+
+@instrument.timed('simulate', items=_n_steps)
+def simulate(prec, evap, param, extra_param, return_states=True,
+             initial_states=None, backend=None):
     '''
+    Runs the tank model over the forcing arrays(T) prec and evap.
 
+    Returns the flow array(T+1) and the state array(T+1, 2), both
+    preallocated float64. The first flow is the dummy initial value.
+    With return_states=False only the running state is kept and the
+    final state array(2) is returned instead of the full trajectory.
+    initial_states -> [S1, S2] to start from, INITIAL_STATES by default
+    backend -> backend to use instead of the one set by set_backend
     '''
-    st = [INITIAL_STATES,]
-    q = [10,]
+    kernel = _load_backend(_backend['name'] if backend is None
+                           else backend)[1]
+    if kernel is not None:
+        return kernel(prec, evap, param, extra_param, return_states,
+                      initial_states)
 
-    for i in range(len(prec)):
-        step_res = _step(prec[i], evap[i], st[i], param, extra_param)
-        q.append(step_res[0])
-        st.append(step_res[1])
+    if initial_states is None:
+        initial_states = INITIAL_STATES
+    n_steps = len(prec)
+    q = np.empty(n_steps + 1)
+    q[0] = 10
+    if return_states:
+        st = np.empty((n_steps + 1, 2))
+        st[0] = initial_states
 
+    state = list(initial_states)
+    for i in range(n_steps):
+        q[i + 1], state = _step(prec[i], evap[i], state, param, extra_param)
+        if return_states:
+            st[i + 1] = state
+
+    if not return_states:
+        st = np.array(state, dtype=float)
     return q, st
 
-def calibrate(prec, evap, extra_param, q_rec, verbose=False):
+def simulate_stream(chunks, param, extra_param, initial_states=None):
+    '''
+    Runs the model over a stream of forcing chunks.
+
+    chunks -> iterable of (prec, evap) array pairs, consumed lazily
+    initial_states -> [S1, S2] to start from, e.g. a loaded checkpoint
+
+    Yields, for every chunk, the flow array with one value per time step
+    of the chunk and the state array(2) at the end of the chunk. Only one
+    chunk is held at a time, so memory does not grow with the record.
+    '''
+    state = INITIAL_STATES if initial_states is None else initial_states
+    for prec, evap in chunks:
+        q, state = simulate(prec, evap, param, extra_param,
+                            return_states=False, initial_states=state)
+        yield q[1:], state
+
+def save_checkpoint(fname, states, n_steps, param=None):
+    '''
+    Writes the model states after n_steps time steps to fname (.npz),
+    with the parameters used if given. The file is replaced atomically so
+    an interrupted write never corrupts the previous checkpoint.
+    '''
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, states=np.asarray(states, dtype=float),
+                 n_steps=n_steps,
+                 param=np.asarray([] if param is None else param, dtype=float))
+    os.replace(tmp, fname)
+
+def load_checkpoint(fname):
+    '''
+    Reads a checkpoint written by save_checkpoint.
+    Returns the states array(2), the number of steps already simulated and
+    the parameters (None if they were not saved).
+    '''
+    with np.load(fname) as ckp:
+        param = ckp['param'] if ckp['param'].size else None
+        return ckp['states'], int(ckp['n_steps']), param
+
+def _step_batch(prec, evap, s1, s2, param, extra_param):
+    '''
+    Vectorised version of _step advancing N tanks at once.
+
+    prec, evap -> scalar forcing for the time step [mm]
+    s1, s2 -> arrays(N) with the old levels of the top and bottom tanks [mm]
+    param -> sequence of 8 arrays(N) [k1, k2, k3, k4, d1, d2, rfcf, ecorr]
+    extra_param -> [DT, AREA] shared by all the members
+
+    The branches of _step are replaced by masks, so every member follows
+    exactly the same arithmetic as the scalar path.
+    Returns the flow array(N) and the new states (S1, S2).
+    '''
+    k1, k2, k3, k4, d1, d2, rfcf, ecorr = param
+    DT = extra_param[0]
+    Area = extra_param[1]
+
+    ## Top tank
+    H1 = np.maximum(s1 + prec*rfcf - evap*ecorr, 0.0)
+    wet = H1 > 0
+
+    q1 = np.where(wet & (H1 > d1), k1*(H1-d1), 0.0)
+    q2 = np.where(wet & (H1 > d2), k2*(H1-d2), 0.0)
+    q3 = np.where(wet, k3*H1, 0.0)
+
+    #Check for availability of water in upper tank
+    q123 = q1+q2+q3
+    short = q123 > H1
+    if short.any():
+        q123 = np.where(short, q123, 1.0)
+        q1 = np.where(short, (q1/q123)*H1, q1)
+        q2 = np.where(short, (q2/q123)*H1, q2)
+        q3 = np.where(short, (q3/q123)*H1, q3)
+
+    Q1 = q1+q2
+    S1New = np.maximum(H1 - (q1+q2+q3), 0.0)
+
+    ## Bottom tank
+    H2 = s2+q3
+    Q2 = np.minimum(k4*H2, H2)
+    S2New = H2 - Q2
+
+    ## Total Flow, zero unless Q1 + Q2 >= 0 (NaN included) as in _step
+    Q12 = Q1+Q2
+    Q = np.where(Q12 >= 0, Q12, 0.0)*Area/(3.6*DT)
+
+    return Q, S1New, S2New
+
+@instrument.timed('simulate_batch', items=_n_member_steps)
+def simulate_batch(prec, evap, params, extra_param, return_states=True,
+                   initial_states=None):
+    '''
+    Runs N parameter sets over the same forcing in one pass.
+
+    prec, evap -> forcing arrays(T)
+    params -> parameter matrix(N, 8), one row per member
+    extra_param -> [DT, AREA]
+    initial_states -> [S1, S2] shared by all members or an array(N, 2),
+                      INITIAL_STATES by default
+
+    Returns the flow array(T+1, N) and the state array(T+1, N, 2),
+    matching column by column what simulate gives for every row.
+    With return_states=False the final states(N, 2) are returned instead.
+    '''
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    n_steps = len(prec)
+    n_sets = params.shape[0]
+    param = [params[:, i] for i in range(8)]
+
+    if initial_states is None:
+        initial_states = INITIAL_STATES
+    initial_states = np.broadcast_to(np.asarray(initial_states, dtype=float),
+                                     (n_sets, 2))
+
+    q = np.empty((n_steps + 1, n_sets))
+    q[0] = 10
+    if return_states:
+        st = np.empty((n_steps + 1, n_sets, 2))
+        st[0] = initial_states
+
+    s1 = initial_states[:, 0].copy()
+    s2 = initial_states[:, 1].copy()
+    for i in range(n_steps):
+        q[i + 1], s1, s2 = _step_batch(prec[i], evap[i], s1, s2, param,
+                                       extra_param)
+        if return_states:
+            st[i + 1, :, 0] = s1
+            st[i + 1, :, 1] = s2
+
+    if not return_states:
+        st = np.column_stack((s1, s2))
+    return q, st
+
+def _step_sens(prec, evap, st, dst, param, extra_param):
+    '''
+    _step with forward-mode sensitivities to the 8 parameters.
+
+    dst -> derivatives(2, 8) of the old states [S1, S2] with respect to
+           [k1, k2, k3, k4, d1, d2, rfcf, ecorr]
+
+    Follows the branches of _step, including the water availability
+    rescaling, and returns Q, dQ(8), the new states and their
+    derivatives(2, 8). Q and the states are identical to _step.
+    '''
+    S1Old, S2Old = st
+    dS1Old, dS2Old = dst
+    k1, k2, k3, k4, d1, d2, rfcf, ecorr = param[:8]
+    DT = extra_param[0]
+    Area = extra_param[1]
+
+    ## Top tank
+    H1 = S1Old + prec*rfcf - evap*ecorr
+    if H1 > 0:
+        dH1 = dS1Old.copy()
+        dH1[6] += prec
+        dH1[7] -= evap
+    else:
+        H1 = 0
+        dH1 = np.zeros(8)
+
+    if H1 > 0:
+        if H1 > d1:
+            q1 = k1*(H1-d1)
+            dq1 = k1*dH1
+            dq1[0] += H1-d1
+            dq1[4] -= k1
+        else:
+            q1 = 0
+            dq1 = np.zeros(8)
+
+        if H1 > d2:
+            q2 = k2*(H1-d2)
+            dq2 = k2*dH1
+            dq2[1] += H1-d2
+            dq2[5] -= k2
+        else:
+            q2 = 0
+            dq2 = np.zeros(8)
+
+        q3 = k3 * H1
+        dq3 = k3*dH1
+        dq3[2] += H1
+
+        q123 = q1+q2+q3
+        if q123 > H1:
+            # d(q*H1/q123) = (dq*H1 + q*dH1 - q*H1*dq123/q123)/q123
+            r = H1/q123
+            dr = (dH1 - r*(dq1+dq2+dq3))/q123
+            dq1 = dq1*r + q1*dr
+            dq2 = dq2*r + q2*dr
+            dq3 = dq3*r + q3*dr
+            q1 = (q1/q123)*H1
+            q2 = (q2/q123)*H1
+            q3 = (q3/q123)*H1
+    else:
+        q1 = q2 = q3 = 0
+        dq1 = dq2 = dq3 = np.zeros(8)
+
+    Q1 = q1+q2
+    dQ1 = dq1+dq2
+    S1New = H1 - (q1+q2+q3)
+    if S1New > 0:
+        dS1New = dH1 - (dQ1+dq3)
+    else:
+        S1New = 0.0
+        dS1New = np.zeros(8)
+
+    ## Bottom tank
+    H2 = S2Old+q3
+    dH2 = dS2Old+dq3
+    Q2 = k4* H2
+    dQ2 = k4*dH2
+    dQ2[3] += H2
+    if Q2 > H2:
+        Q2 = H2
+        dQ2 = dH2
+
+    S2New = H2 - Q2
+    dS2New = dH2 - dQ2
+
+    ## Total Flow
+    if (Q1 + Q2) >= 0:
+        Q = (Q1+Q2)*Area/(3.6*DT)
+        dQ = (dQ1+dQ2)*(Area/(3.6*DT))
+    else:
+        Q = 0
+        dQ = np.zeros(8)
+
+    return Q, dQ, [S1New, S2New], (dS1New, dS2New)
+
+@instrument.timed('simulate_sens', items=_n_steps)
+def simulate_sens(prec, evap, param, extra_param, initial_states=None):
+    '''
+    Runs the model with forward sensitivities in a single pass.
+
+    Returns the flow array(T+1), as simulate, and its derivatives(T+1, 8)
+    with respect to [k1, k2, k3, k4, d1, d2, rfcf, ecorr].
+    initial_states -> [S1, S2] to start from, INITIAL_STATES by default;
+                      they are held fixed, so their derivatives are zero
+    '''
+    n_steps = len(prec)
+    q = np.empty(n_steps + 1)
+    dq = np.empty((n_steps + 1, 8))
+    q[0] = 10
+    dq[0] = 0
+
+    state = INITIAL_STATES if initial_states is None else initial_states
+    dstate = (np.zeros(8), np.zeros(8))
+    for i in range(n_steps):
+        q[i + 1], dq[i + 1], state, dstate = _step_sens(
+            prec[i], evap[i], state, dstate, param, extra_param)
+
+    return q, dq
+
+def calibrate(prec, evap, extra_param, q_rec, verbose=False,
+              method='L-BFGS-B', **options):
+    '''
+    Calibrates the model parameters inside PARAM_BND by maximising NSE.
+
+    method -> 'L-BFGS-B' for a single local search from INITIAL_PARAM, or
+              one of the global strategies of calibration.calibrate_global
+              ('multistart', 'sce', 'de'); options are passed on to it,
+              or to the L-BFGS-B options (e.g. maxiter).
+    Returns the calibrated parameters and the objective (negative NSE).
+    Objective values and results are memoized in cache.CACHE.
+    '''
+    if method != 'L-BFGS-B':
+        import calibration
+        res = calibration.calibrate_global(prec, evap, extra_param, q_rec,
+                                           method=method, **options)
+        return res.x, res.fun
+
+    # Imported here so that importing the model stays cheap
+    import scipy.optimize as opt
+    import calibration
+    from cache import CACHE
+    objective = calibration.Objective(prec, evap, extra_param, q_rec)
+    result_key = objective.result_key('calibrate', INITIAL_PARAM, options)
+    cal_res = CACHE.get(result_key)
+    if cal_res is not None:
+        return cal_res.x, cal_res.fun
 
     def mod_wrap(param_cal):
-        q_sim = simulate(prec[:-1], evap[:-1], param_cal, extra_param)[0]
+        # Objective memoizes, repeated probes are not simulated again
         try:
-            perf_fun = -NSE(q_sim, q_rec)
-        except:
-            perf_fun = 9999
+            perf_fun, perf_grad = objective.value_and_grad(param_cal)
+        except (ArithmeticError, ValueError):
+            perf_fun, perf_grad = calibration.PENALTY, np.zeros(8)
 
-        if verbose: print -perf_fun
-        return perf_fun
+        if verbose:
+            print(-perf_fun)
+        return perf_fun, perf_grad
 
+    # The iterate was just evaluated, the memoized value is returned
+    # without printing it again
+    callback = instrument.optimizer_callback(
+        'calibrate',
+        lambda param_cal: objective.value_and_grad(param_cal)[0])
     cal_res = opt.minimize(mod_wrap, INITIAL_PARAM, bounds=PARAM_BND,
-                           method='L-BFGS-B')
+                           method='L-BFGS-B', jac=True, callback=callback,
+                           options=options or None)
+    CACHE.put(result_key, cal_res)
 
     return cal_res.x, cal_res.fun
 
@@ -171,21 +562,16 @@ def NSE(x,y,q='def',j=2.0):
     q - Quality tag (0-1)
     j - exponent to modify the inflation of the variance (standard NSE j=2)
     """
-    x = np.array(x)
-    y = np.array(y)
-    a = np.sum(np.power(x-y,j))
-    b = np.sum(np.power(y-np.average(y),j))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    err = x-y
+    dev = y-np.average(y)
+    if j == 2:
+        # Standard NSE: dot products instead of a general power
+        a = np.dot(err, err)
+        b = np.dot(dev, dev)
+    else:
+        a = np.sum(np.power(err,j))
+        b = np.sum(np.power(dev,j))
     F = 1.0 - a/b
     return F
-
-
-'''
-TEsting function    
-'''
-for i in range(1000):
-    prec = np.random.uniform(0, 100)
-    evap = np.random.uniform(0, 10)
-    st = [np.random.uniform(0, 30), np.random.uniform(0, 30)]
-    param = [0.1819, 0.0412, 0.3348, 0.0448, 3.2259, 0.3800,1,1, 1]
-    extra_param = [1, 145]
-    _step(prec, evap, st, param, extra_param)
\ No newline at end of file
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the model tests
+
+The model modules are flat files imported by name, as samp1.py does, so
+their folder goes on the path.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import sugawara
+from cache import CACHE
+
+EXTRA_PARAM = [24, 147.0]
+TRUE_PARAM = [0.3, 0.1, 0.02, 0.05, 5.0, 0.5, 1.0, 1.0]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Memoized results would hide the computation under test
+    CACHE.clear()
+    yield
+    CACHE.clear()
+
+
+@pytest.fixture
+def forcing():
+    """Seeded synthetic record: prec, evap, extra_param and q_rec."""
+    rng = np.random.default_rng(0)
+    n_steps = 400
+    prec = rng.gamma(0.5, 8.0, n_steps)*(rng.random(n_steps) < 0.4)
+    evap = rng.uniform(0.5, 4.0, n_steps)
+    q_rec = sugawara.simulate(prec[:-1], evap[:-1], TRUE_PARAM,
+                              EXTRA_PARAM, return_states=False)[0]
+    q_rec = q_rec*rng.lognormal(0.0, 0.05, len(q_rec))
+    return prec, evap, EXTRA_PARAM, q_rec
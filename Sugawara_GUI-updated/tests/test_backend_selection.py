@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import sugawara
+
+
+@pytest.mark.parametrize('value', ['', 'python'])
+def test_default_is_python(monkeypatch, value):
+    monkeypatch.setenv('SUGAWARA_BACKEND', value)
+    assert sugawara._backend_from_environment() == 'python'
+
+
+def test_auto(monkeypatch):
+    monkeypatch.setenv('SUGAWARA_BACKEND', 'auto')
+    expected = 'numba' if 'numba' in sugawara.available_backends() \
+        else 'python'
+    assert sugawara._backend_from_environment() == expected
+
+
+def test_unavailable_name_falls_back_with_a_warning(monkeypatch):
+    monkeypatch.setenv('SUGAWARA_BACKEND', 'fortran')
+    with pytest.warns(RuntimeWarning, match='fortran'):
+        assert sugawara._backend_from_environment() == 'python'
+
+
+def test_missing_numba_falls_back_with_a_warning(monkeypatch):
+    monkeypatch.setenv('SUGAWARA_BACKEND', 'numba')
+    monkeypatch.setitem(sugawara._backend, 'missing', {'numba'})
+    with pytest.warns(RuntimeWarning, match='numba'):
+        name = sugawara._backend_from_environment()
+    assert name == 'python'
+    monkeypatch.setitem(sugawara._backend, 'name', name)
+    q = sugawara.simulate(np.ones(5), np.ones(5), sugawara.INITIAL_PARAM,
+                          [24, 147.0])[0]
+    assert np.isfinite(q).all()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled simulate backends against the Python reference: flows and
+states must be identical, NaN included.
+"""
+import numpy as np
+import pytest
+
+import sugawara
+
+pytest.importorskip('numba')
+
+N_STEPS = 500
+PARAMS = [np.array(sugawara.INITIAL_PARAM, dtype=float)] + list(
+    sugawara.LOWER + np.random.default_rng(7).random((24, 8))
+    *(sugawara.UPPER - sugawara.LOWER))
+
+
+def _forcing(case):
+    rng = np.random.default_rng(11)
+    prec = rng.gamma(0.5, 8.0, N_STEPS)*(rng.random(N_STEPS) < 0.4)
+    evap = rng.uniform(0.5, 4.0, N_STEPS)
+    if case == 'zero':
+        prec = np.zeros(N_STEPS)
+        evap = np.zeros(N_STEPS)
+    elif case == 'dry':
+        prec = np.zeros(N_STEPS)
+    elif case == 'nan':
+        prec[N_STEPS//2] = np.nan
+        evap[N_STEPS//3] = np.nan
+    return prec, evap
+
+
+def _backends():
+    return [name for name in sugawara.available_backends()
+            if name != 'python']
+
+
+def _assert_same(param, prec, evap, **kwargs):
+    extra_param = [24, 147.0]
+    ref = sugawara.simulate(prec, evap, param, extra_param,
+                            backend='python', **kwargs)
+    for name in _backends():
+        out = sugawara.simulate(prec, evap, param, extra_param,
+                                backend=name, **kwargs)
+        for a, b in zip(ref, out):
+            assert np.array_equal(a, b, equal_nan=True), name
+
+
+def test_compiled_backend_available():
+    assert 'numba' in _backends()
+
+
+@pytest.mark.parametrize('case', ['record', 'zero', 'dry', 'nan'])
+@pytest.mark.parametrize('param', PARAMS)
+def test_forcing(param, case):
+    _assert_same(param, *_forcing(case))
+
+
+@pytest.mark.parametrize('param', PARAMS)
+@pytest.mark.parametrize('initial_states', [[0.0, 0.0], [0.0, 55.0],
+                                            [120.0, 3.5]])
+@pytest.mark.parametrize('return_states', [True, False])
+def test_states(param, initial_states, return_states):
+    _assert_same(param, *_forcing('record'), initial_states=initial_states,
+                 return_states=return_states)
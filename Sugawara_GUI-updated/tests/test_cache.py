@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+
+from cache import Cache, key
+
+
+def _value(i):
+    return np.full(100, float(i))
+
+
+def _age(cache, k, mtime):
+    # Explicit modification times, the disk tier's recency order
+    os.utime(cache._path(k), (mtime, mtime))
+
+
+def test_memory_evicts_least_recently_used():
+    cache = Cache(max_items=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['items'] == 2
+
+
+def test_disk_evicts_least_recently_used(tmp_path):
+    cache = Cache(max_items=1, directory=str(tmp_path))
+    cache.put('a', _value(1))
+    size = os.path.getsize(cache._path('a'))
+    cache.max_bytes = 2*size
+    cache.put('b', _value(2))
+    _age(cache, 'a', 1000)
+    _age(cache, 'b', 2000)
+    # Reading 'a' back from disk makes it the most recent entry there
+    cache.clear()
+    np.testing.assert_array_equal(cache.get('a'), _value(1))
+    cache.put('c', _value(3))
+    assert sorted(os.listdir(str(tmp_path))) == ['a.pkl', 'c.pkl']
+    assert cache.stats()['disk_bytes'] == 2*size
+
+
+def test_disk_hit_is_promoted_to_memory(tmp_path):
+    cache = Cache(directory=str(tmp_path))
+    k = key('objective', _value(1))
+    cache.put(k, _value(1))
+    cache.clear()
+    np.testing.assert_array_equal(cache.get(k), _value(1))
+    os.remove(cache._path(k))
+    np.testing.assert_array_equal(cache.get(k), _value(1))
+    assert (cache.hits, cache.disk_hits, cache.misses) == (2, 1, 0)
+
+
+def test_counters():
+    cache = Cache()
+    assert cache.get('a', 'default') == 'default'
+    cache.put('a', 1, persist=False)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (2, 0, 2)
+
+
+def test_memory_only_entries_stay_off_disk(tmp_path):
+    cache = Cache(directory=str(tmp_path))
+    cache.put('a', 1, persist=False)
+    assert os.listdir(str(tmp_path)) == []
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.misses == 1
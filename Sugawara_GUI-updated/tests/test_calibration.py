@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import calibration
+import sugawara
+from cache import CACHE
+
+
+@pytest.mark.parametrize('method, options', [
+    ('multistart', {'n_starts': 3, 'maxiter': 20}),
+    ('sce', {'n_complexes': 3, 'max_evals': 300}),
+    ('de', {'popsize': 12, 'max_evals': 300}),
+])
+def test_workers_do_not_change_result(forcing, method, options):
+    results = []
+    for workers in (1, 2):
+        CACHE.clear()
+        results.append(calibration.calibrate_global(
+            *forcing, method=method, seed=3, workers=workers, **options))
+    serial, parallel = results
+    assert parallel.workers == 2
+    np.testing.assert_array_equal(serial.x, parallel.x)
+    assert serial.fun == parallel.fun
+    np.testing.assert_array_equal(serial.history, parallel.history)
+    assert serial.nfev == parallel.nfev
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_batch_matches_single_evaluations(forcing, weighted):
+    weights = np.linspace(0.5, 1.0, len(forcing[3])) if weighted else None
+    objective = calibration.Objective(*forcing, weights=weights)
+    params = calibration.latin_hypercube(calibration.BATCH_MIN + 5,
+                                         np.random.default_rng(5))
+    np.testing.assert_array_equal(objective.batch(params),
+                                  [objective(param) for param in params])
+
+def test_default_sizes_do_not_follow_workers(forcing):
+    res = calibration.calibrate_global(*forcing, method='sce', seed=1,
+                                       workers=1, max_loops=0)
+    m = 2*len(sugawara.LOWER) + 1
+    assert res.nfev == calibration.N_COMPLEXES*m
+
+
+def test_result_keys_follow_model_version_and_backend(forcing,
+                                                      monkeypatch):
+    objective = calibration.Objective(*forcing)
+    first = objective.result_key('calibrate')
+    monkeypatch.setattr(sugawara, 'MODEL_VERSION',
+                        sugawara.MODEL_VERSION + 1)
+    assert objective.result_key('calibrate') != first
+    monkeypatch.undo()
+    monkeypatch.setitem(sugawara._backend, 'name', 'numba')
+    assert objective.result_key('calibrate') != first
+
+
+def test_calibrate_not_served_across_model_versions(forcing, monkeypatch):
+    x, fun = sugawara.calibrate(*forcing, maxiter=3)
+    misses = CACHE.misses
+    monkeypatch.setattr(sugawara, 'MODEL_VERSION',
+                        sugawara.MODEL_VERSION + 1)
+    sugawara.calibrate(*forcing, maxiter=3)
+    assert CACHE.misses > misses + 1
+
+
+def test_recalibrate_chained_through_checkpoint(forcing, tmp_path):
+    prec, evap, extra_param, q_rec = forcing
+    checkpoint = str(tmp_path/'window.npz')
+    n_first = 300
+    first = calibration.recalibrate(
+        prec[:n_first], evap[:n_first], extra_param,
+        q_rec[:n_first], sugawara.INITIAL_PARAM, window=100,
+        checkpoint=checkpoint, maxiter=5)
+    assert first.moved
+
+    states, n_steps, param = sugawara.load_checkpoint(checkpoint)
+    np.testing.assert_array_equal(param, first.x)
+    np.testing.assert_allclose(states, sugawara.simulate(
+        prec[:n_steps], evap[:n_steps], first.x, extra_param,
+        return_states=False)[1], rtol=1e-12)
+
+    chained = calibration.recalibrate(prec, evap, extra_param, q_rec, first,
+                                      window=100, checkpoint=checkpoint,
+                                      maxiter=5)
+    CACHE.clear()
+    full = calibration.recalibrate(prec, evap, extra_param, q_rec, first,
+                                   window=100, maxiter=5)
+    assert chained.n_advanced == len(q_rec) - n_first
+    assert full.n_advanced == full.window_start
+    np.testing.assert_allclose(chained.x, full.x, rtol=1e-9)
+    np.testing.assert_allclose(chained.fun, full.fun, rtol=1e-9)
+    np.testing.assert_allclose(chained.fun_previous, full.fun_previous,
+                               rtol=1e-12)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Forward sensitivities of simulate_sens and the Objective gradient against
+finite differences of simulate and the Objective.
+
+A point within epsilon of a kink of the model (a tank level crossing d1,
+d2 or zero) gives a one-sided difference that may not match, so the
+points are seeded and the tolerance is relative to the largest
+derivative.
+"""
+import numpy as np
+import pytest
+import scipy.optimize as opt
+
+import calibration
+import sugawara
+
+EPSILON = 1e-7
+RTOL = 1e-4
+
+RANDOM_POINTS = list(sugawara.LOWER
+                     + np.random.default_rng(42).random((12, 8))
+                     *(sugawara.UPPER - sugawara.LOWER))
+# Upper tank outflows exceeding its content, rescaled to the water there
+RESCALED = np.array([1.0, 0.9, 0.5, 0.3, 1.0, 0.2, 1.1, 0.9])
+# Lower tank outflow k4*H2 capped at H2
+K4_ABOVE_ONE = np.array([0.3, 0.1, 0.02, 1.05, 5.0, 0.5, 1.0, 1.0])
+POINTS = RANDOM_POINTS + [RESCALED, K4_ABOVE_ONE]
+
+
+def _relative_error(analytic, numeric):
+    return np.max(np.abs(analytic - numeric))/np.max(np.abs(analytic))
+
+
+def test_branch_points_reach_their_branches(forcing):
+    prec, evap, extra_param, _ = forcing
+    k1, k2, k3, k4, d1, d2, rfcf, ecorr = RESCALED
+    st = sugawara.simulate(prec, evap, RESCALED, extra_param)[1]
+    h1 = np.maximum(st[:-1, 0] + prec*rfcf - evap*ecorr, 0)
+    q123 = k1*np.maximum(h1 - d1, 0) + k2*np.maximum(h1 - d2, 0) + k3*h1
+    assert np.any((h1 > 0) & (q123 > h1))
+    # Any water in the lower tank is then capped
+    st = sugawara.simulate(prec, evap, K4_ABOVE_ONE, extra_param)[1]
+    assert K4_ABOVE_ONE[3] > 1 and np.any(st[:, 1] > 0)
+
+
+@pytest.mark.parametrize('param', POINTS)
+def test_simulate_sens(forcing, param):
+    prec, evap, extra_param, _ = forcing
+    q, dq = sugawara.simulate_sens(prec, evap, param, extra_param)
+    np.testing.assert_array_equal(
+        q, sugawara.simulate(prec, evap, param, extra_param)[0])
+    numeric = opt.approx_fprime(
+        param, lambda p: sugawara.simulate(prec, evap, p, extra_param,
+                                           return_states=False)[0],
+        EPSILON)
+    assert _relative_error(dq, numeric) < RTOL
+
+
+@pytest.mark.parametrize('param', POINTS)
+def test_objective_value_and_grad(forcing, param):
+    objective = calibration.Objective(*forcing)
+    fun, grad = objective.value_and_grad(param)
+    assert fun == objective(param)
+    numeric = opt.approx_fprime(param, objective, EPSILON)
+    assert _relative_error(grad, numeric) < RTOL
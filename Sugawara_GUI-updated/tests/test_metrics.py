@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+import metrics
+from ascfile import read_asc
+
+OUTPUT_ASC = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'output.asc')
+# Settings under which HBVX computed the header error values
+HBVX = {'warmup': 100, 'low_threshold': 5.0, 'peak_threshold': 25.0}
+
+
+@pytest.fixture
+def asc():
+    return read_asc(OUTPUT_ASC, cache=False)
+
+
+def test_evaluate_reproduces_hbvx_header(asc):
+    scores = metrics.evaluate(asc['Qcomp'], asc['Qrec'], **HBVX)
+    errors = asc.errors
+    # The header gives four decimals
+    for name, label in [('NSE', 'Coefficient of efficiency'),
+                        ('RMSE', 'Weighted root mean squared error'),
+                        ('WRMSE', 'Weighted root mean squared error'),
+                        ('RMSE_low', 'RMSE of LOW flow events'),
+                        ('RMSE_peak', 'RMSE of PEAK flow events')]:
+        assert scores[name] == pytest.approx(errors[label], abs=5e-5), name
+
+
+def test_evaluate_matches_definitions(asc):
+    sim = np.asarray(asc['Qcomp'], dtype=float)[HBVX['warmup']:]
+    obs = np.asarray(asc['Qrec'], dtype=float)[HBVX['warmup']:]
+    scores = metrics.evaluate(asc['Qcomp'], asc['Qrec'], **HBVX)
+
+    r = np.corrcoef(sim, obs)[0, 1]
+    kge = 1.0 - np.sqrt((r - 1)**2 + (sim.std()/obs.std() - 1)**2
+                        + (sim.mean()/obs.mean() - 1)**2)
+    eps = 0.01*obs.mean()
+    lsim, lobs = np.log(sim + eps), np.log(obs + eps)
+    log_nse = 1.0 - (np.sum((lsim - lobs)**2)
+                     /np.sum((lobs - lobs.mean())**2))
+    assert scores['KGE'] == pytest.approx(kge, rel=1e-12)
+    assert scores['logNSE'] == pytest.approx(log_nse, rel=1e-12)
+
+    single = {'NSE': metrics.nse, 'RMSE': metrics.rmse, 'KGE': metrics.kge,
+              'logNSE': metrics.log_nse}
+    for name, fun in single.items():
+        assert scores[name] == pytest.approx(
+            fun(asc['Qcomp'], asc['Qrec'], warmup=HBVX['warmup']),
+            rel=1e-12), name
+    assert scores['RMSE_low'] == pytest.approx(metrics.low_flow_rmse(
+        asc['Qcomp'], asc['Qrec'], HBVX['warmup'], 5.0), rel=1e-12)
+    assert scores['RMSE_peak'] == pytest.approx(metrics.peak_flow_rmse(
+        asc['Qcomp'], asc['Qrec'], HBVX['warmup'], 25.0), rel=1e-12)
+
+
+def test_ensemble_with_gaps_matches_columns(asc):
+    rng = np.random.default_rng(4)
+    obs = np.array(asc['Qrec'], dtype=float)
+    obs[rng.choice(len(obs), 40, replace=False)] = np.nan
+    sim = np.asarray(asc['Qcomp'], dtype=float)[:, None] \
+        * rng.lognormal(0.0, 0.2, (1, 6))
+    # Every member has its own gaps, one has none
+    for j in range(1, sim.shape[1]):
+        sim[rng.choice(len(obs), 10*j, replace=False), j] = np.nan
+
+    ensemble = metrics.evaluate(sim, obs, **HBVX)
+    for j in range(sim.shape[1]):
+        column = metrics.evaluate(sim[:, j], obs, **HBVX)
+        for name, value in column.items():
+            assert ensemble[name][j] == pytest.approx(value, rel=1e-12), \
+                (name, j)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import threading
+from urllib.error import HTTPError
+
+import numpy as np
+import pytest
+
+import metrics
+import sugawara
+from service import SimulationService, request, run_in_thread
+
+PARAM = [0.3, 0.1, 0.02, 0.05, 5.0, 0.5, 1.0, 1.0]
+PARAMS = [PARAM, sugawara.INITIAL_PARAM,
+          [0.5, 0.2, 0.05, 0.1, 10.0, 1.0, 0.5, 2.0],
+          [0.1, 0.05, 0.01, 0.02, 2.0, 0.2, 1.5, 0.5]]
+
+
+@pytest.fixture
+def serve(forcing):
+    """start(**options) serves the forcing record, returns (service, url)."""
+    prec, evap, extra_param, q_rec = forcing
+    datasets = {'synthetic': {'prec': prec[:-1], 'evap': evap[:-1],
+                              'q_rec': q_rec, 'extra_param': extra_param}}
+    services = []
+
+    def start(**options):
+        service = SimulationService(datasets, workers=1, backend='python',
+                                    **options)
+        services.append(service)
+        return service, 'http://127.0.0.1:%d' % run_in_thread(service)
+
+    yield start
+    for service in services:
+        service.close()
+
+
+def _simulate(forcing, param):
+    prec, evap, extra_param, _ = forcing
+    return sugawara.simulate(prec[:-1], evap[:-1], param, extra_param,
+                             return_states=False)[0]
+
+
+def test_simulate(forcing, serve):
+    _, url = serve()
+    reply = request(url + '/simulate', {'dataset': 'synthetic',
+                                        'param': PARAM})
+    np.testing.assert_array_equal(reply['q'], _simulate(forcing, PARAM))
+
+
+def test_score(forcing, serve):
+    _, url = serve()
+    reply = request(url + '/score', {'dataset': 'synthetic',
+                                     'param': PARAM, 'warmup': 50})
+    expected = metrics.evaluate(_simulate(forcing, PARAM), forcing[3],
+                                warmup=50)
+    assert reply == pytest.approx(dict((k, float(v))
+                                       for k, v in expected.items()),
+                                  rel=1e-12)
+
+
+def test_concurrent_requests_share_one_batch(forcing, serve):
+    # The window outlasts the requests, so only max_batch closes the batch
+    service, url = serve(window=60.0, max_batch=len(PARAMS))
+    replies = [None]*len(PARAMS)
+
+    def send(i):
+        replies[i] = request(url + '/score', {'dataset': 'synthetic',
+                                              'param': PARAMS[i]})
+
+    threads = [threading.Thread(target=send, args=(i,))
+               for i in range(len(PARAMS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = request(url + '/stats')
+    assert stats['batches'] == 1
+    assert stats['mean_batch'] == len(PARAMS)
+    for param, reply in zip(PARAMS, replies):
+        assert reply['NSE'] == pytest.approx(
+            float(metrics.nse(_simulate(forcing, param), forcing[3])),
+            rel=1e-12)
+
+
+@pytest.mark.parametrize('payload', [
+    {'dataset': 'missing', 'param': PARAM},
+    {'dataset': 'synthetic', 'param': PARAM[:7]},
+    {'dataset': 'synthetic', 'param': PARAM, 'warmup': 400},
+    {'param': PARAM},
+])
+def test_bad_requests_get_400(serve, payload):
+    _, url = serve()
+    with pytest.raises(HTTPError) as err:
+        request(url + '/score', payload)
+    assert err.value.code == 400
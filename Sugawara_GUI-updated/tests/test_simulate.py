@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+simulate_batch and simulate_stream against plain simulate runs: flows and
+states must be identical, NaN included.
+"""
+import numpy as np
+import pytest
+
+import sugawara
+
+EXTRA_PARAM = [24, 147.0]
+N_STEPS = 300
+PARAMS = np.array([
+    sugawara.INITIAL_PARAM,
+    [0.3, 0.1, 0.02, 0.05, 5.0, 0.5, 1.0, 1.0],
+    # Outflows above the storage: the shortage and k4 > 1 clamps
+    [0.9, 0.8, 0.7, 1.5, 1.0, 0.5, 1.0, 1.0],
+    # Evaporation above the storage: an empty top tank (H1 <= 0)
+    [0.3, 0.1, 0.02, 0.05, 5.0, 0.5, 0.1, 3.0],
+    # Negative percolation: a negative total flow is reported as zero
+    [0.3, 0.1, -0.02, 0.05, 5.0, 0.5, 1.0, 1.0],
+    # NaN coefficients: a NaN flow is reported as zero
+    [0.3, np.nan, 0.02, 0.05, 5.0, 0.5, 1.0, 1.0],
+    [0.3, 0.1, 0.02, np.nan, 5.0, 0.5, 1.0, 1.0],
+    [0.3, 0.1, 0.02, 0.05, 5.0, 0.5, np.nan, 1.0],
+] + list(sugawara.LOWER + np.random.default_rng(7).random((8, 8))
+         *(sugawara.UPPER - sugawara.LOWER)))
+
+
+def _forcing(case):
+    rng = np.random.default_rng(11)
+    prec = rng.gamma(0.5, 8.0, N_STEPS)*(rng.random(N_STEPS) < 0.4)
+    evap = rng.uniform(0.5, 4.0, N_STEPS)
+    if case == 'dry':
+        prec = np.zeros(N_STEPS)
+    elif case == 'nan':
+        prec[N_STEPS//2] = np.nan
+        evap[N_STEPS//3] = np.nan
+    return prec, evap
+
+
+@pytest.mark.parametrize('case', ['record', 'dry', 'nan'])
+@pytest.mark.parametrize('initial_states', [None, [0.0, 0.0], [120.0, 3.5]])
+def test_batch_columns_match_simulate(case, initial_states):
+    prec, evap = _forcing(case)
+    q, st = sugawara.simulate_batch(prec, evap, PARAMS, EXTRA_PARAM,
+                                    initial_states=initial_states)
+    for i, param in enumerate(PARAMS):
+        q_ref, st_ref = sugawara.simulate(prec, evap, param, EXTRA_PARAM,
+                                          initial_states=initial_states,
+                                          backend='python')
+        assert np.array_equal(q[:, i], q_ref, equal_nan=True), i
+        assert np.array_equal(st[:, i], st_ref, equal_nan=True), i
+
+
+def _chunks(prec, evap, start, stop, size):
+    for i in range(start, stop, size):
+        yield prec[i:min(i + size, stop)], evap[i:min(i + size, stop)]
+
+
+@pytest.mark.parametrize('size', [1, 40, N_STEPS])
+def test_stream_resumed_from_checkpoint_matches_simulate(tmp_path, size):
+    prec, evap = _forcing('record')
+    param = PARAMS[1]
+    q_ref, st_ref = sugawara.simulate(prec, evap, param, EXTRA_PARAM,
+                                      return_states=True, backend='python')
+    checkpoint = str(tmp_path/'state.npz')
+    n_first = 170
+
+    q = []
+    for q_chunk, state in sugawara.simulate_stream(
+            _chunks(prec, evap, 0, n_first, size), param, EXTRA_PARAM):
+        q.append(q_chunk)
+    sugawara.save_checkpoint(checkpoint, state, n_first, param)
+
+    states, n_steps, saved = sugawara.load_checkpoint(checkpoint)
+    assert n_steps == n_first
+    np.testing.assert_array_equal(saved, param)
+    np.testing.assert_array_equal(states, st_ref[n_first])
+    for q_chunk, state in sugawara.simulate_stream(
+            _chunks(prec, evap, n_steps, N_STEPS, size), param, EXTRA_PARAM,
+            initial_states=states):
+        q.append(q_chunk)
+    np.testing.assert_array_equal(np.concatenate(q), q_ref[1:])
+    np.testing.assert_array_equal(state, st_ref[-1])
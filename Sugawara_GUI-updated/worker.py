@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process data of the process pools
+
+The data every task of a pool needs (objective, forcing, datasets) is
+sent once to each worker process by the pool initializer install and
+kept in STATE, instead of being pickled with every task:
+
+    pool = ProcessPoolExecutor(max_workers=n, initializer=worker.install,
+                               initargs=('glue', data))
+    ...
+    data = worker.STATE['glue']              # inside a task
+
+Without a pool the same call installs the data in the calling process.
+Each module keeps its data under its own name, so they do not clash when
+they run in one process.
+"""
+from __future__ import division
+import os
+
+# Data of the tasks running in this process, by module name
+STATE = {}
+
+
+def default_workers():
+    """Number of worker processes used when none is given."""
+    return os.cpu_count() or 1
+
+
+def install(name, value, backend=None):
+    """
+    Keeps value under name in this process; backend -> sugawara.simulate
+    backend to select there as well.
+    """
+    STATE[name] = value
+    if backend is not None:
+        import sugawara
+        sugawara.set_backend(backend)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Homogeneity (change-point) tests of rainfall series
+
+pettitt -> Pettitt's rank test, asymptotic p-value
+snht -> Standard Normal Homogeneity Test (Alexandersson), Monte Carlo
+        p-value
+buishand -> Buishand U test, Monte Carlo p-value
+
+The statistics follow pyhomogeneity, used by the notebook, but each is
+computed in O(n) from cumulative sums: Pettitt's U_k from the cumulative
+sum of the ranks instead of the double sum over pairs, SNHT and Buishand
+from the cumulative sum of the deviations from the mean.
+
+The SNHT and Buishand statistics are invariant to location and scale, so
+their null distributions depend only on the series length. They are
+simulated from standard normal series in blocks (time x simulations) and
+cached per length and number of simulations: every station of the same
+length shares one null, and all the lengths of a call share the random
+draws, since a shorter series is a prefix of a longer one.
+
+screen runs the three tests on all stations of a StationStore at daily,
+monthly and annual aggregation in one call. Lengths within a relative
+tolerance (1% by default there) share a null distribution, which changes
+little with n at these lengths.
+"""
+from __future__ import division
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+TESTS = ('pettitt', 'snht', 'buishand')
+LEVELS = ('daily', 'monthly', 'annual')
+SIM = 10000
+# Simulated series per block of the Monte Carlo null distributions
+BLOCK = 256
+
+# Sorted null statistics by (test, length, sim, seed)
+_NULLS = {}
+
+
+def _prepare(x):
+    """Series without its missing values and the positions kept."""
+    x = np.asarray(x, dtype=float)
+    keep = np.flatnonzero(np.isfinite(x))
+    return x[keep], keep
+
+
+def pettitt_statistic(x):
+    """
+    U_k = 2 sum_{i<=k} r_i - k(n+1) for k = 1..n-1 from the cumulative
+    sum of the (mid-)ranks r; returns K = max|U_k| and its k.
+    """
+    n = len(x)
+    k = np.arange(1, n)
+    u = 2*np.cumsum(rankdata(x))[:-1] - k*(n + 1)
+    i = np.argmax(np.abs(u))
+    return abs(u[i]), int(k[i])
+
+
+def snht_statistic(x):
+    """
+    T_k = k z1^2 + (n-k) z2^2 of the standardized series for k = 1..n-1;
+    returns max T_k and its k.
+    """
+    t = _snht_curve(np.asarray(x, dtype=float)[:, None])[:, 0]
+    i = np.argmax(t)
+    return float(t[i]), int(i + 1)
+
+
+def buishand_statistic(x):
+    """
+    U = sum_{k<n} (S_k/D)^2/(n(n+1)) with S_k the cumulative deviations
+    from the mean and D the standard deviation; returns U and the k of
+    max|S_k|.
+    """
+    x = np.asarray(x, dtype=float)
+    s = np.cumsum(x - x.mean())[:-1]
+    n = len(x)
+    u = np.sum(s**2)/(np.var(x)*n*(n + 1))
+    return float(u), int(np.argmax(np.abs(s)) + 1)
+
+
+def _snht_curve(x):
+    # x(n, m): T_k = n S_k^2/(var k (n-k)) with S_k the cumulative sum of
+    # the deviations, which equals k z1^2 + (n-k) z2^2
+    n = len(x)
+    c = np.cumsum(x, axis=0)
+    mean = c[-1]/n
+    var = (np.sum(x**2, axis=0) - n*mean**2)/(n - 1)
+    k = np.arange(1, n)[:, None]
+    s = c[:-1] - k*mean
+    return n*s**2/(var*k*(n - k))
+
+
+# Null distributions
+
+def reference_length(n, tolerance=0.0):
+    """
+    Length whose null distribution stands for series of length n: n
+    itself, or with a tolerance the nearest point of a geometric grid of
+    that relative step (below about 0.5/tolerance values it is still n).
+    """
+    if not tolerance:
+        return int(n)
+    step = np.log1p(tolerance)
+    return int(round(np.exp(round(np.log(n)/step)*step)))
+
+
+def null_distribution(lengths, sim=SIM, seed=0):
+    """
+    Sorted Monte Carlo null statistics of SNHT and Buishand,
+    {(test, n): array(sim)} for the series lengths asked. Results are
+    cached, and the lengths missing from the cache are simulated together
+    from the same normal draws.
+    """
+    lengths = sorted(set(int(n) for n in lengths))
+    todo = [n for n in lengths if ('snht', n, sim, seed) not in _NULLS]
+    if todo:
+        n_max = max(todo)
+        found = dict(((test, n), []) for test in TESTS[1:] for n in todo)
+        for b, start in enumerate(range(0, sim, BLOCK)):
+            # Time on axis 0, so the first n rows of a block do not depend
+            # on n_max
+            rng = np.random.default_rng([seed, b])
+            z = rng.standard_normal((n_max, min(BLOCK, sim - start)))
+            c = np.cumsum(z, axis=0)
+            c2 = np.cumsum(z**2, axis=0)
+            for n in todo:
+                mean = c[n - 1]/n
+                ss = c2[n - 1] - n*mean**2
+                k = np.arange(1, n)[:, None]
+                s2 = k*mean
+                np.subtract(c[:n - 1], s2, out=s2)
+                s2 **= 2
+                found['buishand', n].append(s2.sum(axis=0)/(ss*(n + 1)))
+                s2 *= n*(n - 1)/(k*(n - k))
+                found['snht', n].append(s2.max(axis=0)/ss)
+        for (test, n), values in found.items():
+            _NULLS[test, n, sim, seed] = np.sort(np.concatenate(values))
+    return dict(((test, n), _NULLS[test, n, sim, seed])
+                for test in TESTS[1:] for n in lengths)
+
+
+def _p_value(null, stat):
+    """Fraction of the null statistics larger than stat."""
+    return (len(null) - np.searchsorted(null, stat, side='right'))/len(null)
+
+
+def _pettitt_p(stat, n):
+    return min(1.0, 2*np.exp(-6*stat**2/(n**3 + n**2)))
+
+
+# Tests
+
+def _result(x, keep, stat, k, p, alpha):
+    # cp is the position, in the series with its gaps, of the last value
+    # before the change (as pyhomogeneity)
+    return {'stat': stat, 'p': float(p), 'h': bool(p < alpha),
+            'n': len(x), 'cp': int(keep[k - 1]),
+            'mu1': float(np.mean(x[:k])), 'mu2': float(np.mean(x[k:]))}
+
+
+def pettitt(x, alpha=0.05):
+    """
+    Pettitt test of a series (missing values are dropped).
+
+    Returns a dict with stat (K), p, h (p < alpha), n, cp (index in x of
+    the last value before the change) and mu1, mu2 (means before and
+    after). The p-value is the asymptotic one, pyhomogeneity's sim=None.
+    """
+    x, keep = _prepare(x)
+    stat, k = pettitt_statistic(x)
+    return _result(x, keep, float(stat), k, _pettitt_p(stat, len(x)), alpha)
+
+
+def snht(x, alpha=0.05, sim=SIM, seed=0, tolerance=0.0):
+    """
+    SNHT of a series, same results as pettitt (stat is max T_k).
+    tolerance -> relative length difference of a shared null distribution
+                 (see reference_length), 0 for the exact length
+    """
+    x, keep = _prepare(x)
+    stat, k = snht_statistic(x)
+    n = reference_length(len(x), tolerance)
+    null = null_distribution([n], sim, seed)['snht', n]
+    return _result(x, keep, stat, k, _p_value(null, stat), alpha)
+
+
+def buishand(x, alpha=0.05, sim=SIM, seed=0, tolerance=0.0):
+    """Buishand U test of a series, same arguments and results as snht."""
+    x, keep = _prepare(x)
+    stat, k = buishand_statistic(x)
+    n = reference_length(len(x), tolerance)
+    null = null_distribution([n], sim, seed)['buishand', n]
+    return _result(x, keep, stat, k, _p_value(null, stat), alpha)
+
+
+# Screening
+
+def aggregate(store, level, min_coverage=0.9):
+    """
+    Dates and totals array(n_stations, n_periods) of a StationStore at
+    'daily', 'monthly' or 'annual' level. A period with fewer than
+    min_coverage of its days observed is missing; the others are scaled
+    up from the mean of the days observed.
+    """
+    values = np.asarray(store.values)
+    if level == 'daily':
+        return store.dates, values
+    if level == 'monthly':
+        starts = store.month_start
+    elif level == 'annual':
+        starts = store.year_start
+    else:
+        raise ValueError('level is one of %s, not %r'
+                         % (', '.join(LEVELS), level))
+    valid = np.isfinite(values)
+    days = np.diff(starts)
+    count = np.add.reduceat(valid, starts[:-1], axis=1)
+    total = np.add.reduceat(np.where(valid, values, 0.0), starts[:-1],
+                            axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.where(count >= min_coverage*days, total*days/count,
+                         np.nan)
+    return store.dates[starts[:-1]], total
+
+
+def screen(store, levels=LEVELS, stations=None, alpha=0.05, sim=SIM,
+           seed=0, min_coverage=0.9, tolerance=0.01):
+    """
+    Runs the three tests on every station of a StationStore at each
+    aggregation level.
+
+    min_coverage -> see aggregate
+    tolerance -> see snht; daily series with a few different gaps then
+                 share one null distribution instead of one each
+
+    Returns a DataFrame with a row per station, level and test: stat, p,
+    h, n, the change point date and the means before and after it, plus
+    the wall time in its attrs.
+    """
+    start = time.perf_counter()
+    stations = list(stations or store.stations)
+    rows = [store.stations.index(s) for s in stations]
+    series = []
+    for level in levels:
+        dates, values = aggregate(store, level, min_coverage)
+        for station, row in zip(stations, rows):
+            x, keep = _prepare(values[row])
+            if len(x) > 2:
+                series.append((level, station, dates, x, keep))
+    nulls = null_distribution([reference_length(len(s[3]), tolerance)
+                               for s in series], sim, seed)
+
+    records = []
+    for level, station, dates, x, keep in series:
+        n = len(x)
+        ref = reference_length(n, tolerance)
+        stats = {'pettitt': pettitt_statistic(x),
+                 'snht': snht_statistic(x),
+                 'buishand': buishand_statistic(x)}
+        for test in TESTS:
+            stat, k = stats[test]
+            p = (_pettitt_p(stat, n) if test == 'pettitt'
+                 else _p_value(nulls[test, ref], stat))
+            record = _result(x, keep, float(stat), k, p, alpha)
+            record.update(level=level, station=station, test=test,
+                          date=pd.Timestamp(dates[record['cp']]))
+            records.append(record)
+    table = pd.DataFrame(records, columns=[
+        'level', 'station', 'test', 'stat', 'p', 'h', 'n', 'cp', 'date',
+        'mu1', 'mu2'])
+    table.attrs['wall_time'] = time.perf_counter() - start
+    return table
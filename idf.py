@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Intensity-duration-frequency (IDF) curves of many stations
+
+Fits the IDF relation of the notebook
+
+    i = k T^x/(D + a)^n,  i.e.  ln(i) = c0 + c1 ln(T) + c2 ln(D + a)
+
+with k = exp(c0), x = c1 and n = -c2, to the return levels of every
+station at once:
+
+    annual = store.annual_maxima([1, 3, 5, 10, 15, 30])
+    result = fit_idf(annual)
+    tables(result)['Gulu']                 # durations x return periods
+
+The return levels come from frequency.fit (Gumbel by moments, as the
+notebook's K_T, by default). For a given a the model is linear in c, so
+all stations and all trial values of a are solved together as one
+stacked least-squares problem (QR, no normal equations). a is picked per
+station on a grid and refined by a golden-section search, also for all
+stations at once.
+"""
+from __future__ import division
+import time
+
+import numpy as np
+import pandas as pd
+
+import frequency
+
+# Golden-section iterations refining a between grid points
+_GOLDEN_STEPS = 40
+_INVPHI = (np.sqrt(5) - 1)/2
+
+
+def _design(durations, return_periods, a):
+    """X(..., m, 3) for the (duration, period) pairs and a(...)."""
+    d, t = np.meshgrid(durations, return_periods, indexing='ij')
+    a = np.asarray(a, dtype=float)[..., None]
+    d, t = d.ravel(), t.ravel()
+    x = np.empty(a.shape[:-1] + (len(d), 3))
+    x[..., 0] = 1.0
+    x[..., 1] = np.log(t)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x[..., 2] = np.log(d + a)
+    return x
+
+
+def _lstsq(x, y, w):
+    """
+    Coefficients(..., 3) and weighted sum of squared residuals(...) of the
+    stacked problems x(..., m, 3) c = y(..., m), rows of weight 0 left
+    out.
+    """
+    xw = x*w[..., None]
+    yw = y*w
+    q, r = np.linalg.qr(xw)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coef = np.linalg.solve(r, np.einsum('...mk,...m->...k', q, yw)
+                               [..., None])[..., 0]
+    residual = yw - np.einsum('...mk,...k->...m', xw, coef)
+    return coef, np.sum(residual**2, axis=-1)
+
+
+def fit_curves(levels, durations, return_periods, a=None, a_grid=None,
+               intensity=True):
+    """
+    Fits the IDF relation to return levels of several stations.
+
+    levels -> rainfall depths array(n_stations, n_durations, n_periods),
+              NaN where missing
+    durations, return_periods -> values of the levels' axes; a has the
+                                 unit of the durations
+    a -> fixed a (e.g. the notebook's 1.2 days), searched by default
+    a_grid -> trial values of a, 0 to the longest duration by default
+    intensity -> fit i = depth/duration; False fits the depths, as the
+                 notebook (whose 0.1 factor only scales k)
+
+    Returns a dict with k, x, n, a, coef (array(n_stations, 3)) and the
+    rmse of ln(i), per station.
+    """
+    levels = np.asarray(levels, dtype=float)
+    durations = np.asarray(durations, dtype=float)
+    return_periods = np.asarray(return_periods, dtype=float)
+    n_stations = len(levels)
+    value = levels/durations[:, None] if intensity else levels
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.log(value).reshape(n_stations, -1)
+    w = np.isfinite(y).astype(float)
+    y = np.where(w > 0, y, 0.0)
+    # Stations with fewer levels than coefficients get a dummy problem,
+    # so the stacked solve stays regular, and NaN results
+    short = w.sum(axis=-1) < 4
+    w[short] = 1.0
+
+    def sse(trial):
+        # trial(..., n_stations) -> coef and SSE for every station
+        x = _design(durations, return_periods, trial)
+        return _lstsq(x, np.broadcast_to(y, x.shape[:-1]), w)
+
+    if a is not None:
+        best = np.full(n_stations, float(a))
+    else:
+        if a_grid is None:
+            a_grid = np.linspace(0, durations.max(), 101)
+        a_grid = np.asarray(a_grid, dtype=float)
+        trial = np.repeat(a_grid[:, None], n_stations, axis=1)
+        errors = sse(trial)[1]
+        errors = np.where(np.isfinite(errors), errors, np.inf)
+        i = np.argmin(errors, axis=0)
+        # Golden-section search between the neighbours of the best point
+        lo = a_grid[np.maximum(i - 1, 0)]
+        hi = a_grid[np.minimum(i + 1, len(a_grid) - 1)]
+        for _ in range(_GOLDEN_STEPS):
+            c = hi - _INVPHI*(hi - lo)
+            d = lo + _INVPHI*(hi - lo)
+            left = sse(np.stack([c, d]))[1]
+            closer = left[0] < left[1]
+            hi = np.where(closer, d, hi)
+            lo = np.where(closer, lo, c)
+        best = (lo + hi)/2
+
+    coef, errors = sse(best)
+    rmse = np.sqrt(errors/w.sum(axis=-1))
+    coef[short] = rmse[short] = best[short] = np.nan
+    return {'k': np.exp(coef[:, 0]), 'x': coef[:, 1], 'n': -coef[:, 2],
+            'a': best, 'coef': coef, 'rmse': rmse}
+
+
+def model_intensity(result, durations, return_periods):
+    """Model intensities array(n_stations, n_durations, n_periods)."""
+    d = np.asarray(durations, dtype=float)[None, :, None]
+    t = np.asarray(return_periods, dtype=float)[None, None, :]
+    k, x, n, a = (result[key][:, None, None] for key in ('k', 'x', 'n', 'a'))
+    return k*t**x/(d + a)**n
+
+
+def fit_idf(annual, return_periods=frequency.RETURN_PERIODS,
+            distribution='gumbel', method='moments', unit='days', **options):
+    """
+    IDF curves of every station from StationStore.annual_maxima.
+
+    annual -> dict with maxima (stations x years x durations), stations and
+              durations
+    distribution, method -> frequency.fit of the return levels
+    unit -> unit of the durations in annual, also that of a and of the
+            intensities (mm per unit)
+    options -> fit_curves options (a, a_grid, intensity)
+
+    Returns the fit_curves dict plus stations, durations, return_periods,
+    unit, levels (the fitted return levels, stations x durations x
+    periods), observed and model intensities and wall_time.
+    """
+    start = time.perf_counter()
+    durations = np.asarray(annual['durations'], dtype=float)
+    params = frequency.fit(annual['maxima'], distribution, method, axis=1)
+    levels = frequency.return_levels(params, distribution, return_periods)
+    result = fit_curves(levels, durations, return_periods, **options)
+    divide = options.get('intensity', True)
+    result.update(stations=list(annual['stations']), durations=durations,
+                  return_periods=np.asarray(return_periods), unit=unit,
+                  levels=levels,
+                  observed=levels/durations[:, None] if divide else levels,
+                  model=model_intensity(result, durations,
+                                        return_periods))
+    result['wall_time'] = time.perf_counter() - start
+    return result
+
+
+def tables(result, model=True):
+    """
+    {station: DataFrame} of intensities with the durations as index and
+    the return periods as columns (the notebook's FinalData_df); the
+    fitted curve by default, the return levels with model=False.
+    """
+    values = result['model'] if model else result['observed']
+    return dict((station, pd.DataFrame(
+        values[i], index=pd.Index(result['durations'], name=result['unit']),
+        columns=pd.Index(result['return_periods'], name='T')))
+        for i, station in enumerate(result['stations']))
+
+
+def coefficients(result):
+    """DataFrame of k, x, n, a and rmse with a row per station."""
+    return pd.DataFrame(dict((key, result[key])
+                             for key in ('k', 'x', 'n', 'a', 'rmse')),
+                        index=pd.Index(result['stations'], name='station'))
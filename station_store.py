@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store for daily station rainfall
+
+The station CSV (a date column and one column per station, -9999 for
+missing values, as daily_data1.csv) is parsed once, sorted, put on a
+complete daily calendar and written as a binary store in __stationstore__
+next to the CSV, keyed by the file size and mtime. Later reads
+memory-map the store instead of parsing the text again.
+
+Values are kept as one float64 array(n_stations, n_days), so every
+station is a contiguous row. The year and month start offsets are stored
+with the data, and station, year, month and period selections are
+slices (views) of the memory map. annual_maxima extracts the annual
+maximum accumulations of many durations for all stations in one pass.
+"""
+from __future__ import division
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = '__stationstore__'
+MISSING = -9999
+
+
+class StationStore(object):
+    """
+    Daily rainfall of several stations.
+
+    stations -> station names, in the order of the CSV columns
+    start -> numpy datetime64[D] of the first day
+    values -> array(n_stations, n_days), NaN where data are missing
+    years -> calendar years covered
+    year_start -> index of the first day of every year, plus n_days
+    month_start -> index of the first day of every month from the first
+                   month, plus n_days
+    """
+
+    def __init__(self, fname, header, values, offsets):
+        self.fname = fname
+        self.stations = header['stations']
+        self.start = np.datetime64(header['start'], 'D')
+        self.values = values
+        self.years = offsets['years']
+        self.year_start = offsets['year_start']
+        self.month_start = offsets['month_start']
+        self._index = dict((s, i) for i, s in enumerate(self.stations))
+
+    def __len__(self):
+        return self.values.shape[1]
+
+    def __getitem__(self, station):
+        return self.station(station)
+
+    @property
+    def dates(self):
+        """datetime64[D] array with the date of every day."""
+        return self.start + np.arange(len(self))
+
+    def station(self, station):
+        """Series(n_days) of one station, a view of the store."""
+        return self.values[self._index[station]]
+
+    def day_index(self, date):
+        """Index of a date (anything np.datetime64 accepts)."""
+        return int((np.datetime64(date, 'D') - self.start).astype(np.int64))
+
+    def period(self, start=None, end=None, stations=None):
+        """
+        Dates and values(n_stations, n) from start to end, both included.
+        Without a station list the values are a view of the store.
+        """
+        i0 = 0 if start is None else max(self.day_index(start), 0)
+        i1 = len(self) if end is None else min(self.day_index(end) + 1,
+                                               len(self))
+        values = self.values[:, i0:i1]
+        if stations is not None:
+            values = values[[self._index[s] for s in stations]]
+        return self.dates[i0:i1], values
+
+    def year_slice(self, year):
+        """Slice of the days of a calendar year."""
+        k = int(year) - int(self.years[0])
+        return slice(int(self.year_start[k]), int(self.year_start[k + 1]))
+
+    def month_slice(self, year, month):
+        """Slice of the days of a calendar month."""
+        first = self.start.astype('datetime64[M]').astype(np.int64)
+        k = (int(year) - 1970)*12 + int(month) - 1 - first
+        return slice(int(self.month_start[k]), int(self.month_start[k + 1]))
+
+    def year(self, year):
+        """Values(n_stations, days of the year), a view of the store."""
+        return self.values[:, self.year_slice(year)]
+
+    def month(self, year, month):
+        """Values(n_stations, days of the month), a view of the store."""
+        return self.values[:, self.month_slice(year, month)]
+
+    def to_frame(self):
+        """DataFrame indexed by date with a column per station (a copy)."""
+        return pd.DataFrame(np.asarray(self.values).T, columns=self.stations,
+                            index=pd.DatetimeIndex(self.dates, name='date'))
+
+    def annual_maxima(self, durations, unit='days', stations=None,
+                      cross_year=False, max_missing=0.0, min_coverage=0.0):
+        """
+        Annual maximum rainfall accumulated over each duration, for all
+        stations at once (see annual_maxima).
+
+        durations -> window lengths, in days or, with unit='hours', in
+                     hours (multiples of 24)
+        stations -> station names, all by default
+
+        Returns a dict with maxima (array(n_stations, n_years,
+        n_durations), NaN for years without a valid window), stations,
+        years and durations.
+        """
+        durations = np.atleast_1d(np.asarray(durations))
+        if unit == 'hours':
+            if np.any(durations % 24):
+                raise ValueError('hourly durations of daily data must be '
+                                 'multiples of 24')
+            days = durations//24
+        elif unit == 'days':
+            days = durations
+        else:
+            raise ValueError("unit is 'days' or 'hours', not %r" % unit)
+        values = self.values
+        if stations is not None:
+            values = values[[self._index[s] for s in stations]]
+        maxima = annual_maxima(values, self.year_start, days.astype(int),
+                               cross_year, max_missing, min_coverage)
+        return {'maxima': maxima,
+                'stations': list(stations or self.stations),
+                'years': self.years, 'durations': durations}
+
+
+def annual_maxima(values, year_start, durations, cross_year=False,
+                  max_missing=0.0, min_coverage=0.0):
+    """
+    Annual maxima of the running sums of every duration.
+
+    One cumulative sum of the data (gaps as zero) and one of the valid-day
+    count per station give every window sum and its number of missing
+    days as a difference, so each duration costs O(n) for all stations
+    and all years together.
+
+    values -> array(n_stations, n_days), NaN for missing days
+    year_start -> first day of each year, plus n_days (StationStore)
+    durations -> window lengths in days
+    cross_year -> windows ending early in a year may start in the previous
+                  one; by default a window lies within one year. A window
+                  belongs to the year of its last day.
+    max_missing -> fraction of missing days allowed in a window, whose
+                   sum then counts them as zero; 0 keeps complete windows
+    min_coverage -> fraction of valid days a year needs, below it the year
+                    is NaN
+
+    Returns array(n_stations, n_years, n_durations).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    year_start = np.asarray(year_start)
+    n_stations, n_days = values.shape
+    valid = np.isfinite(values)
+    csum = np.zeros((n_stations, n_days + 1))
+    np.cumsum(np.where(valid, values, 0.0), axis=1, out=csum[:, 1:])
+    ccount = np.zeros((n_stations, n_days + 1), dtype=np.int64)
+    np.cumsum(valid, axis=1, out=ccount[:, 1:])
+
+    starts = year_start[:-1]
+    n_years = len(starts)
+    year_of = np.repeat(np.arange(n_years), np.diff(year_start))
+    first_day = 0 if cross_year else starts[year_of]
+    end = np.arange(1, n_days + 1)
+
+    maxima = np.full((n_stations, n_years, len(durations)), np.nan)
+    for k, d in enumerate(durations):
+        d = int(d)
+        if d < 1:
+            raise ValueError('durations must be at least one day')
+        # Window (end-d, end] of every day that can close one
+        fits = end - d >= first_day
+        lo = np.where(fits, end - d, 0)
+        sums = csum[:, 1:] - csum[:, lo]
+        missing = d - (ccount[:, 1:] - ccount[:, lo])
+        ok = fits & (missing <= max_missing*d)
+        # Years whose windows all fail stay NaN
+        sums = np.where(ok, sums, -np.inf)
+        year_max = np.maximum.reduceat(sums, starts, axis=1)
+        maxima[:, :, k] = np.where(np.isneginf(year_max), np.nan, year_max)
+
+    if min_coverage > 0:
+        covered = np.add.reduceat(valid, starts, axis=1)/np.diff(year_start)
+        maxima[covered < min_coverage] = np.nan
+    return maxima
+
+
+def _offsets(start, n_days):
+    dates = start + np.arange(n_days)
+    years = dates.astype('datetime64[Y]')
+    months = dates.astype('datetime64[M]')
+    # Every period starts where the calendar changes; n_days closes the last
+    year_start = np.r_[np.flatnonzero(np.r_[True, years[1:] != years[:-1]]),
+                       n_days]
+    month_start = np.r_[np.flatnonzero(np.r_[True,
+                                             months[1:] != months[:-1]]),
+                        n_days]
+    first_year = years[0].astype(np.int64) + 1970
+    return {'years': first_year + np.arange(len(year_start) - 1),
+            'year_start': year_start, 'month_start': month_start}
+
+
+# Binary store: values.npy (memory-mapped), offsets.npz and a .json header
+# recording the CSV's size and mtime, written last so that an interrupted
+# write never looks valid
+
+def _cache_paths(fname):
+    folder, base = os.path.split(os.path.abspath(fname))
+    cache = os.path.join(folder, CACHE_DIR, base)
+    return cache + '.npy', cache + '.npz', cache + '.json'
+
+
+def _read_cache(fname, stat):
+    npy, npz, meta = _cache_paths(fname)
+    try:
+        with open(meta) as f:
+            header = json.load(f)
+        if (header.pop('mtime_ns'), header.pop('size')) \
+                != (stat.st_mtime_ns, stat.st_size):
+            return None
+        with np.load(npz) as offsets:
+            return header, np.load(npy, mmap_mode='r'), dict(offsets)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_cache(fname, stat, header, values, offsets):
+    npy, npz, meta = _cache_paths(fname)
+    info = json.dumps(dict(header, mtime_ns=stat.st_mtime_ns,
+                           size=stat.st_size)).encode()
+    try:
+        os.makedirs(os.path.dirname(npy), exist_ok=True)
+        for path, write in ((npy, lambda f: np.save(f, values)),
+                            (npz, lambda f: np.savez(f, **offsets)),
+                            (meta, lambda f: f.write(info))):
+            with open(path + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+    except OSError:
+        # Unwritable folder: the store is used without its cache
+        pass
+
+
+def read_stations(fname, date_column='date', cache=True):
+    """
+    Reads a daily station CSV into a StationStore.
+
+    date_column -> name of the date column, every other column is a station
+    cache -> use and refresh the binary store in __stationstore__; it is
+             rebuilt whenever the file size or modification time changes
+    """
+    stat = os.stat(fname)
+    if cache:
+        cached = _read_cache(fname, stat)
+        if cached is not None:
+            return StationStore(fname, *cached)
+
+    data = pd.read_csv(fname, na_values=[MISSING], index_col=date_column,
+                       parse_dates=True)
+    data = data[~data.index.isna()].sort_index()
+    data = data[~data.index.duplicated(keep='first')]
+    days = pd.date_range(data.index[0].normalize(),
+                         data.index[-1].normalize(), freq='D')
+    data = data.reindex(days)
+    values = np.ascontiguousarray(data.to_numpy(dtype=np.float64).T)
+    values[values == MISSING] = np.nan
+
+    start = np.datetime64(days[0].date(), 'D')
+    header = {'stations': [str(c) for c in data.columns],
+              'start': str(start)}
+    offsets = _offsets(start, len(days))
+    if cache:
+        _write_cache(fname, stat, header, values, offsets)
+    return StationStore(fname, header, values, offsets)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the rainfall analysis tests
+
+The analysis modules are flat files at the top of the repository,
+imported by name, so that folder goes on the path.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+STATIONS = ['Gulu', 'Kitgum', 'Lira']
+
+
+@pytest.fixture
+def daily():
+    """
+    Seeded daily rainfall, 1990-1999, with missing days (NaN) and one
+    station without data for most of a year.
+    """
+    rng = np.random.default_rng(0)
+    days = pd.date_range('1990-01-01', '1999-12-31', freq='D', name='date')
+    # Gauges read to 0.1 mm, which also survives the trip through a CSV
+    values = np.round(rng.gamma(0.6, 9.0, (len(days), len(STATIONS)))
+                      * (rng.random((len(days), len(STATIONS))) < 0.35), 1)
+    values[rng.random(values.shape) < 0.03] = np.nan
+    values[(days.year == 1994) & (days.month > 2), 1] = np.nan
+    return pd.DataFrame(values, index=days, columns=STATIONS)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from itertools import combinations
+
+import numpy as np
+import pytest
+from scipy import special, stats
+
+import frequency
+
+
+@pytest.fixture
+def samples():
+    """Seeded GEV annual maxima, 6 series x 40 years, one with gaps."""
+    x = stats.genextreme.rvs(-0.1, loc=50.0, scale=15.0, size=(6, 40),
+                             random_state=np.random.default_rng(2))
+    x[2, 5:9] = np.nan
+    return x
+
+
+def _series(samples):
+    for i, x in enumerate(samples):
+        yield i, x[np.isfinite(x)]
+
+
+def test_gev_mle_matches_scipy(samples):
+    params = frequency.fit(samples, 'gev', 'mle')
+    for i, x in _series(samples):
+        # scipy's shape c is -xi
+        c, loc, scale = stats.genextreme.fit(x)
+        loglik = stats.genextreme.logpdf(x, -params[i, 2], params[i, 0],
+                                         params[i, 1]).sum()
+        assert loglik >= stats.genextreme.logpdf(x, c, loc, scale).sum() \
+            - 1e-8
+        np.testing.assert_allclose(params[i], [loc, scale, -c], rtol=1e-4,
+                                   atol=1e-4)
+
+
+def test_gumbel_mle_matches_scipy(samples):
+    params = frequency.fit(samples, 'gumbel', 'mle')
+    for i, x in _series(samples):
+        np.testing.assert_allclose(params[i], stats.gumbel_r.fit(x),
+                                   rtol=1e-8)
+
+
+def test_lmoments_match_definitions(samples):
+    l1, l2, t3 = frequency.lmoments(samples)
+    for i, x in _series(samples):
+        # Averages over all pairs and triples of ordered observations
+        pairs = [b - a for a, b in combinations(np.sort(x), 2)]
+        triples = [c - 2*b + a for a, b, c in combinations(np.sort(x), 3)]
+        assert l1[i] == pytest.approx(np.mean(x), rel=1e-12)
+        assert l2[i] == pytest.approx(np.mean(pairs)/2, rel=1e-12)
+        assert t3[i] == pytest.approx(np.mean(triples)/3/l2[i], rel=1e-10)
+
+
+def test_gev_lmoment_fit_reproduces_lmoments(samples):
+    loc, scale, xi = np.moveaxis(frequency.fit(samples, 'gev'), -1, 0)
+    l1, l2, t3 = frequency.lmoments(samples)
+    k = -xi
+    g = special.gamma(1 + k)
+    np.testing.assert_allclose(loc + scale*(1 - g)/k, l1, rtol=1e-12)
+    np.testing.assert_allclose(scale*(1 - 2**-k)*g/k, l2, rtol=1e-12)
+    # The shape comes from Hosking's approximation of the t3 relation
+    np.testing.assert_allclose(2*(1 - 3**-k)/(1 - 2**-k) - 3, t3, atol=1e-3)
+
+
+def _analysis(maxima, **options):
+    return frequency.frequency_analysis(maxima, axis=1, n_boot=60,
+                                        chunk_size=25, **options)
+
+
+def test_bootstrap_shape_and_seed(samples):
+    # stations x years x durations, as StationStore.annual_maxima
+    maxima = np.stack([samples, 1.5*samples], axis=-1)
+    result = _analysis(maxima, workers=1, seed=4)
+    n_periods = len(frequency.RETURN_PERIODS)
+    for d in frequency.DISTRIBUTIONS:
+        for name in ('quantiles', 'lower', 'upper'):
+            assert result[name][d].shape == (6, 2, n_periods), (name, d)
+        assert np.all(result['lower'][d] <= result['upper'][d])
+
+    again = _analysis(maxima, workers=2, seed=4)
+    other = _analysis(maxima, workers=1, seed=5)
+    for d in frequency.DISTRIBUTIONS:
+        np.testing.assert_array_equal(again['lower'][d], result['lower'][d])
+        np.testing.assert_array_equal(again['upper'][d], result['upper'][d])
+        assert not np.array_equal(other['lower'][d], result['lower'][d])
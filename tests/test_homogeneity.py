@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import homogeneity
+
+SIM = 300
+
+
+def _series():
+    # Small series with a shift, rounded so that ties (mid-ranks) occur
+    rng = np.random.default_rng(8)
+    for n in (5, 12, 31, 60):
+        x = rng.gamma(2.0, 10.0, n)
+        x[n//2:] += 8.0
+        yield np.round(x)
+
+
+def _pettitt(x):
+    # U_k = sum_{i<=k} sum_{j>k} sign(x_i - x_j)
+    n = len(x)
+    u = [sum(np.sign(x[i] - x[j]) for i in range(k) for j in range(k, n))
+         for k in range(1, n)]
+    return max(abs(v) for v in u), int(np.argmax(np.abs(u))) + 1
+
+
+def _snht(x):
+    # T_k = k mean(z_1..z_k)^2 + (n-k) mean(z_k+1..z_n)^2
+    n = len(x)
+    z = (x - x.mean())/x.std(ddof=1)
+    t = [k*z[:k].mean()**2 + (n - k)*z[k:].mean()**2 for k in range(1, n)]
+    return max(t), int(np.argmax(t)) + 1
+
+
+def _buishand(x):
+    # U = sum_{k<n} (S_k/D)^2/(n(n+1)), S_k = sum_{i<=k} (x_i - mean)
+    n = len(x)
+    s = [np.sum(x[:k] - x.mean()) for k in range(1, n)]
+    u = sum((v/x.std())**2 for v in s)/(n*(n + 1))
+    return u, int(np.argmax(np.abs(s))) + 1
+
+
+@pytest.mark.parametrize('statistic, definition', [
+    (homogeneity.pettitt_statistic, _pettitt),
+    (homogeneity.snht_statistic, _snht),
+    (homogeneity.buishand_statistic, _buishand),
+])
+def test_statistics_match_definitions(statistic, definition):
+    for x in _series():
+        stat, k = statistic(x)
+        expected, expected_k = definition(x)
+        assert stat == pytest.approx(expected, rel=1e-10), len(x)
+        assert k == expected_k, len(x)
+
+
+@pytest.fixture
+def nulls(monkeypatch):
+    """Empty null distribution cache for the test."""
+    monkeypatch.setattr(homogeneity, '_NULLS', {})
+    return homogeneity._NULLS
+
+
+def test_null_is_simulated_once_per_length(nulls, monkeypatch):
+    x = next(s for s in _series() if len(s) == 31)
+    first = homogeneity.null_distribution([31], sim=SIM)
+    snht = homogeneity.snht(x, sim=SIM)
+    buishand = homogeneity.buishand(x, sim=SIM)
+
+    def no_draws(*args, **kwargs):
+        raise AssertionError('null distribution simulated again')
+
+    monkeypatch.setattr(homogeneity.np.random, 'default_rng', no_draws)
+    again = homogeneity.null_distribution([31], sim=SIM)
+    for k in first:
+        assert again[k] is first[k]
+    assert homogeneity.snht(x, sim=SIM) == snht
+    assert homogeneity.buishand(x, sim=SIM) == buishand
+    assert sorted(nulls) == [('buishand', 31, SIM, 0), ('snht', 31, SIM, 0)]
+
+
+def test_lengths_simulated_together_match_alone(nulls):
+    together = homogeneity.null_distribution([20, 31], sim=SIM)
+    nulls.clear()
+    alone = homogeneity.null_distribution([20], sim=SIM)
+    for test in ('snht', 'buishand'):
+        np.testing.assert_array_equal(together[test, 20], alone[test, 20])
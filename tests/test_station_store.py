@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import station_store
+
+DURATIONS = [1, 2, 5, 30]
+
+
+@pytest.fixture
+def store(daily, tmp_path):
+    # The CSV as the stations deliver it: -9999 for missing values, some
+    # dates left out and rows out of order
+    fname = str(tmp_path/'daily.csv')
+    rows = daily.fillna(station_store.MISSING)
+    rows = rows.drop(rows.index[[40, 41, 1000, 2500]])
+    rows.sample(frac=1.0, random_state=1).to_csv(fname)
+    return station_store.read_stations(fname)
+
+
+def _naive(daily, d, cross_year):
+    if cross_year:
+        return daily.rolling(d).sum().groupby(daily.index.year).max()
+    return daily.groupby(daily.index.year).apply(
+        lambda year: year.rolling(d).sum().max())
+
+
+def _dropped(daily):
+    daily = daily.copy()
+    daily.iloc[[40, 41, 1000, 2500]] = np.nan
+    return daily
+
+
+@pytest.mark.parametrize('cross_year', [False, True])
+def test_annual_maxima_match_rolling_sums(daily, store, cross_year):
+    daily = _dropped(daily)
+    result = store.annual_maxima(DURATIONS, cross_year=cross_year)
+    assert result['stations'] == list(daily.columns)
+    for k, d in enumerate(DURATIONS):
+        expected = _naive(daily, d, cross_year)
+        np.testing.assert_array_equal(result['years'], expected.index)
+        np.testing.assert_allclose(result['maxima'][:, :, k],
+                                   expected.to_numpy().T, rtol=1e-10,
+                                   atol=1e-9)
+
+
+def test_cached_store_reads_the_same(daily, store):
+    again = station_store.read_stations(store.fname)
+    assert isinstance(again.values, np.memmap)
+    assert again.stations == store.stations
+    np.testing.assert_array_equal(again.values, store.values)
+    np.testing.assert_array_equal(
+        np.asarray(store.values).T, _dropped(daily).to_numpy())
+    np.testing.assert_array_equal(again.annual_maxima(DURATIONS)['maxima'],
+                                  store.annual_maxima(DURATIONS)['maxima'])